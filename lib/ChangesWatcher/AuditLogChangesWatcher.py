@@ -18,6 +18,9 @@ class AuditLogChangesWatcher(ChangesWatcher):
         self.samba_monitor_sleep_time = samba_config.get('monitor_sleep_time', 1)
         self.samba_audit_log_file = None
 
+        # The beginning of a line which wasn't completely written yet
+        self.partial_line = ''
+
     def start(self) -> bool:
         """ Starts the changes watcher """
         self.samba_audit_log_file = None
@@ -36,15 +39,25 @@ class AuditLogChangesWatcher(ChangesWatcher):
             self.logger.error('Error opening %s, cant monitor it.' % self.samba_audit_log)
             return False
 
-    def watch(self, timeout: float) -> int:
+    def watch(self, timeout: float, during_crawl: bool = False) -> int:
         """ Monitors the given file descriptor for changes until the timeout is reached. """
 
         stop_at = time.time() + timeout
-        self.logger.info('Monitoring Samba audit log until next indexing run in %s seconds.' % timeout)
+        if not during_crawl:
+            self.logger.info('Monitoring Samba audit log until next indexing run in %s seconds.' % timeout)
 
         changes = 0
         while time.time() <= stop_at:
+            if not during_crawl:
+                # Commands of the control socket are executed between two lines
+                self.indexer.process_control_commands()
+
             line = self.samba_audit_log_file.readline()
+            if line and not line.endswith('\n'):
+                # The rest of this line isn't written yet: read it after the next readline()
+                self.partial_line += line
+                continue
+
             if not line:
                 # Was the file log rotated?
                 # logrotate's copytruncate works by copying the file and removing the contents of the original
@@ -55,8 +68,13 @@ class AuditLogChangesWatcher(ChangesWatcher):
                 #   (at the old location). The problem is, that this new file WILL be created AFTER the rename and
                 #   we could possible try to read in between! So we have to test if the file exist and possibly wait a
                 #   bit before we try again.
+                #   The new file may already be bigger than our position, so we compare the inodes too.
                 try:
-                    file_was_rotated = self.samba_audit_log_file.tell() > os.path.getsize(self.samba_audit_log)
+                    audit_log_stat = os.stat(self.samba_audit_log)
+                    file_was_rotated = (
+                        self.samba_audit_log_file.tell() > audit_log_stat.st_size
+                        or os.fstat(self.samba_audit_log_file.fileno()).st_ino != audit_log_stat.st_ino
+                    )
                     if file_was_rotated:
                         self.logger.info('Samba audit log was rotated and a new file exists at "%s".' % self.samba_audit_log)
                 except FileNotFoundError:
@@ -69,6 +87,7 @@ class AuditLogChangesWatcher(ChangesWatcher):
                     self.logger.info('Reopening Samba audit log "%s"...' % self.samba_audit_log)
                     self.samba_audit_log_file.close()
                     self.samba_audit_log_file = None
+                    self.partial_line = ''
                     while time.time() <= stop_at and self.samba_audit_log_file is None:
                         try:
                             self.samba_audit_log_file = open(self.samba_audit_log, 'r')
@@ -84,11 +103,13 @@ class AuditLogChangesWatcher(ChangesWatcher):
                     continue
 
                 else:
-                    # Nothing new in the audit log - sleep for X seconds
-
-                    time.sleep(self.samba_monitor_sleep_time)
+                    # Nothing new in the audit log - sleep for X seconds (but not beyond the timeout)
+                    time.sleep(max(0, min(self.samba_monitor_sleep_time, stop_at - time.time())))
                     continue
 
+            line = self.partial_line + line
+            self.partial_line = ''
+
             self.logger.debug('* Got new line: "%s"' % line.strip())
 
             re_match = re.match(r'^.*\|(openat|unlinkat|renameat|mkdirat)\|ok\|(.*)$', line)
@@ -115,11 +136,18 @@ class AuditLogChangesWatcher(ChangesWatcher):
                 # openat has another value "r" or "w", we only want to react to "w"
                 openat_operation = values.pop()
                 if openat_operation == 'w':
-                    changes += self.indexer.import_path(values.pop())
+                    path = values.pop()
+                    self.mark_dirty(path)
+                    changes += self.indexer.import_path(path)
                 else:
                     self.logger.debug('*- not interested: expected openat with w, but got "%s"' % openat_operation)
 
             elif operation == 'renameat':
+                if len(values) < 2:
+                    # e. g. the end of a line, if we reopened a copytruncated audit log in the middle of a line
+                    self.logger.debug('*- not interested: renameat without target')
+                    continue
+
                 source_path = values.pop()
                 target_path = values.pop()
 
@@ -129,15 +157,21 @@ class AuditLogChangesWatcher(ChangesWatcher):
                     # This should not happen for a renameat, but oh well...
                     continue
 
+                self.mark_dirty(source_path)
+                self.mark_dirty(target_path)
                 self.indexer.rename_path(
                     source_path,
                     target_path,
                 )
 
             elif operation == 'mkdirat':
-                changes += self.indexer.import_path(values.pop())
+                path = values.pop()
+                self.mark_dirty(path)
+                changes += self.indexer.import_path(path)
             elif operation == 'unlinkat':
-                changes += self.indexer.delete_path(values.pop())
+                path = values.pop()
+                self.mark_dirty(path)
+                changes += self.indexer.delete_path(path)
             else:
                 self.logger.debug('*- not interested: unrecognized operation: %s' % operation)
                 continue
@@ -1,5 +1,8 @@
 #-*- coding: utf-8 -*-
 
+import os
+import typing
+
 
 class ChangesWatcher(object):
     """ A watcher for filesystem changes """
@@ -8,10 +11,61 @@ class ChangesWatcher(object):
         self.indexer = indexer
         self.logger = self.indexer.logger
 
+        # The parent directories of all created, deleted or renamed paths since the last indexing run
+        self.dirty_directories = set()
+        self.dirty_directories_overflow = False
+
     def start(self) -> bool:
         """ Starts the changes watcher """
         pass
 
-    def watch(self, timeout: float) -> int:
-        """ Watches for changes until the timeout is reached. """
+    def watch(self, timeout: float, during_crawl: bool = False) -> int:
+        """
+        Watches for changes until the timeout is reached.
+
+        during_crawl: called while the crawl governor pauses a crawl, so the commands of the control socket (which
+        may crawl themselves) are left for later.
+        """
         pass
+
+    def mark_dirty(self, path: str):
+        """ Remembers the parent directory of a created, deleted or renamed path """
+        if ':' in path:
+            # A xattr of a file, see Fs2EsIndexer.import_path()
+            return
+
+        if self.dirty_directories_overflow:
+            return
+
+        self.dirty_directories.add(os.path.dirname(path.rstrip('/')))
+        if len(self.dirty_directories) > self.indexer.dirty_subtrees_max_directories:
+            # Too many to be worth it, the next indexing run will be a full one
+            self.dirty_directories_overflow = True
+            self.dirty_directories = set()
+
+    def pop_dirty_directories(self) -> typing.Union[list[str], None]:
+        """
+        Returns the minimal set of directories covering all dirty directories and forgets them
+
+        Returns None if there were too many dirty directories to remember them all.
+        """
+
+        overflow = self.dirty_directories_overflow
+        # Sorted by path components: a parent directory always comes directly before its subdirectories
+        dirty_directories = sorted(self.dirty_directories, key=lambda directory: directory.split('/'))
+        self.dirty_directories = set()
+        self.dirty_directories_overflow = False
+
+        if overflow:
+            return None
+
+        covering_directories = []
+        for directory in dirty_directories:
+            if len(covering_directories) > 0 and (
+                directory == covering_directories[-1] or directory.startswith(covering_directories[-1] + '/')
+            ):
+                continue
+
+            covering_directories.append(directory)
+
+        return covering_directories
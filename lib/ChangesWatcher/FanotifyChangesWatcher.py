@@ -38,27 +38,37 @@ class FanotifyChangesWatcher(ChangesWatcher):
 
         return True
 
-    def watch(self, timeout: float) -> int:
+    def watch(self, timeout: float, during_crawl: bool = False) -> int:
         """ Watches for changes via fanotify until the timeout is reached. """
 
         stop_at = time.time() + timeout
-        self.logger.info('Monitoring changes via fanotify until next indexing run in %s seconds.' % timeout)
+        if not during_crawl:
+            self.logger.info('Monitoring changes via fanotify until next indexing run in %s seconds.' % timeout)
 
         changes = 0
         while time.time() <= stop_at:
-            poll_timeout = stop_at - time.time()
+            # Wake up at least every second to execute the commands of the control socket
+            poll_timeout = max(0, min(1, stop_at - time.time()))
             self.logger.debug('Polling for fanotify events with timeout %d seconds.' % poll_timeout)
             # Wait for next event with a timeout (in ms)
             self.poller.poll(poll_timeout * 1000)
+            if not during_crawl:
+                self.indexer.process_control_commands()
+
             for event in self.fanotify_client.get_events():
                 if fan.FAN_CREATE & event.ev_types:
-                    changes += self.indexer.import_path(event.path[0].decode('utf-8'))
+                    path = event.path[0].decode('utf-8')
+                    self.mark_dirty(path)
+                    changes += self.indexer.import_path(path)
                 elif fan.FAN_DELETE & event.ev_types | fan.FAN_DELETE_SELF & event.ev_types:
-                    changes += self.indexer.delete_path(event.path[0].decode('utf-8'))
+                    path = event.path[0].decode('utf-8')
+                    self.mark_dirty(path)
+                    changes += self.indexer.delete_path(path)
                 elif fan.FAN_RENAME & event.ev_types:
-                    changes += self.indexer.rename_path(
-                        event.path[0].decode('utf-8'),
-                        event.path[1].decode('utf-8'),
-                    )
+                    source_path = event.path[0].decode('utf-8')
+                    target_path = event.path[1].decode('utf-8')
+                    self.mark_dirty(source_path)
+                    self.mark_dirty(target_path)
+                    changes += self.indexer.rename_path(source_path, target_path)
 
         return changes
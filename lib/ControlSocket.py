@@ -0,0 +1,93 @@
+#-*- coding: utf-8 -*-
+
+import json
+import os
+import socket
+import socketserver
+import threading
+import typing
+
+
+class ControlSocketServer(object):
+    """
+    Listens on a local unix domain socket for commands to the running daemon
+
+    Every connection sends one JSON request (a line like {"command": "status"}) and receives one JSON response line.
+    The commands are handled by the given handler (see Fs2EsIndexerPool.control()).
+    """
+
+    def __init__(self, path: str, handler: typing.Callable[[dict], dict], logger):
+        self.path = path
+        self.handler = handler
+        self.logger = logger
+        self.server = None
+
+    def start(self):
+        """ Binds the socket (only accessible by our user) and serves it in a background thread """
+
+        if os.path.exists(self.path):
+            # A leftover of a previous daemon
+            os.unlink(self.path)
+
+        directory = os.path.dirname(self.path)
+        if directory != '' and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory, mode=0o700)
+            except OSError as err:
+                self.logger.error('Failed to create the directory of the control socket "%s": %s' % (self.path, str(err)))
+                exit(1)
+
+        control_socket = self
+
+        class RequestHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                response = control_socket.handle_line(self.rfile.readline())
+                self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+        self.server = socketserver.ThreadingUnixStreamServer(self.path, RequestHandler, bind_and_activate=False)
+        self.server.daemon_threads = True
+        try:
+            self.server.server_bind()
+            os.chmod(self.path, 0o600)
+            self.server.server_activate()
+        except OSError as err:
+            self.logger.error('Failed to listen on the control socket "%s": %s' % (self.path, str(err)))
+            exit(1)
+
+        threading.Thread(target=self.server.serve_forever, name='fs2es-indexer-control', daemon=True).start()
+        self.logger.info('Listening for commands on the control socket "%s".' % self.path)
+
+    def handle_line(self, line: bytes) -> dict:
+        """ Parses one request and returns the response of the handler """
+        try:
+            request = json.loads(line)
+        except ValueError:
+            return {'ok': False, 'error': 'The request is no valid JSON.'}
+
+        if type(request) is not dict or 'command' not in request:
+            return {'ok': False, 'error': 'The request needs a "command".'}
+
+        self.logger.info('Control socket: got command "%s".' % request['command'])
+        try:
+            return self.handler(request)
+        except Exception as err:
+            self.logger.error('Control socket: command "%s" failed: %s' % (request['command'], repr(err)))
+            return {'ok': False, 'error': repr(err)}
+
+
+class ControlSocketClient(object):
+    """ Sends a command to the control socket of a running daemon """
+
+    def __init__(self, path: str, timeout: float = 10):
+        self.path = path
+        self.timeout = timeout
+
+    def send(self, request: dict) -> dict:
+        """ Sends the request and returns the response of the daemon """
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+            client.settimeout(self.timeout)
+            client.connect(self.path)
+            client.sendall(json.dumps(request).encode('utf-8') + b'\n')
+
+            with client.makefile('rb') as f:
+                return json.loads(f.readline())
@@ -0,0 +1,95 @@
+#-*- coding: utf-8 -*-
+
+import threading
+import time
+import typing
+
+
+class CrawlGovernor(object):
+    """
+    Limits the I/O of a crawl, so the crawler doesn't starve the samba clients working on the same disks
+
+    The crawler reports every directory listing (with its latency and the amount of stats it entails). The governor
+    pauses the crawl to stay below max_listings_per_second and max_stats_per_second. The latency of the listings is
+    the contention signal: if it rises above latency_threshold, the crawl is slowed down further (by the backoff
+    factor, up to max_backoff) and sped up again once the latency dropped.
+
+    With several shares, all indexers share one governor: the limits apply to all crawls together.
+    """
+
+    def __init__(self, governor_config: dict[str, typing.Any], logger):
+        self.logger = logger
+
+        self.max_listings_per_second = governor_config.get('max_listings_per_second', 0)
+        self.max_stats_per_second = governor_config.get('max_stats_per_second', 0)
+        self.latency_threshold = governor_config.get('latency_threshold_ms', 50) / 1000
+        self.max_backoff = max(1, governor_config.get('max_backoff', 16))
+
+        # The smoothed latency of the listings and the current slow down factor
+        self.latency = None
+        self.backoff = 1
+
+        # The time the last listing (of any crawl) was allowed to start
+        self.last_listing_at = None
+        self.lock = threading.Lock()
+
+    def throttle(self, listing_latency: float, stats: int,
+                 pause: typing.Callable[[float], typing.Any] = time.sleep) -> float:
+        """
+        Called after every directory listing of a crawl: pauses the crawl as long as necessary
+
+        The crawl is paused by calling pause with the amount of seconds (e. g. to handle filesystem changes meanwhile).
+        Returns the amount of seconds the crawl was paused.
+        """
+
+        with self.lock:
+            self.adapt(listing_latency)
+
+            # The time this listing may take at the configured rates
+            delay = 0
+            if self.max_listings_per_second > 0:
+                delay = max(delay, 1 / self.max_listings_per_second)
+            if self.max_stats_per_second > 0:
+                delay = max(delay, stats / self.max_stats_per_second)
+
+            # Slow down the configured rates, or (without rates) spend only 1 / backoff of the time on listings
+            delay = max(delay * self.backoff, listing_latency * (self.backoff - 1))
+
+            # Reserve the next slot, so concurrent crawls queue up behind each other
+            now = time.time()
+            if self.last_listing_at is None:
+                self.last_listing_at = now
+            else:
+                self.last_listing_at = max(now, self.last_listing_at + delay)
+            duration = self.last_listing_at - now
+
+        if duration > 0:
+            pause(duration)
+
+        return duration
+
+    def adapt(self, listing_latency: float):
+        """ Learns the latency of the listings and adapts the backoff factor to it """
+
+        if self.latency is None:
+            self.latency = listing_latency
+        else:
+            self.latency = 0.9 * self.latency + 0.1 * listing_latency
+
+        if self.latency_threshold <= 0:
+            return
+
+        backoff = self.backoff
+        if self.latency > self.latency_threshold:
+            self.backoff = min(self.max_backoff, self.backoff * 2)
+        elif self.latency < self.latency_threshold / 2:
+            self.backoff = max(1, self.backoff / 2)
+
+        if backoff == 1 and self.backoff > 1:
+            self.logger.info(
+                'Crawl governor: the directory listings take %.1f ms, slowing down the crawl.' % (self.latency * 1000)
+            )
+        elif backoff > 1 and self.backoff == 1:
+            self.logger.info(
+                'Crawl governor: the directory listings take %.1f ms again, crawling at full speed.' % (self.latency * 1000)
+            )
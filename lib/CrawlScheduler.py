@@ -0,0 +1,158 @@
+#-*- coding: utf-8 -*-
+
+import time
+import typing
+
+
+class CrawlSchedulerUnit(object):
+    """ A directory (or subtree) which is crawled on its own schedule """
+
+    def __init__(self, path: str, interval: float):
+        self.path = path.rstrip('/')
+        self.interval = interval
+
+        # Crawl every unit during the first indexing run
+        self.next_run = 0
+        self.last_crawl = None
+
+        # The amount of paths crawled during the last crawl (= our estimate of its I/O cost)
+        self.cost = 0
+
+        # The learned change rate (changes per second) and the changes seen by the watchers since the last crawl
+        self.rate = None
+        self.watched_changes = 0
+
+
+class CrawlScheduler(object):
+    """
+    Decides which directories (or subtrees) are crawled during an indexing run in daemon mode
+
+    Each unit learns its change rate from the changes found by its crawls and from the changes the watchers saw
+    in it. Units with a high change rate are crawled often (down to min_interval), cold ones rarely
+    (up to max_interval). The sum of the estimated costs of all units crawled in one run is limited by io_budget.
+    """
+
+    def __init__(self, directories: list[str], scheduler_config: dict[str, typing.Any], min_interval: float,
+                 max_interval: float, logger):
+        self.logger = logger
+
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.io_budget = scheduler_config.get('io_budget', 0)
+
+        self.units = []
+        unit_paths = []
+        for path in directories + scheduler_config.get('subtrees', []):
+            if path.rstrip('/') not in unit_paths:
+                unit_paths.append(path.rstrip('/'))
+                self.units.append(CrawlSchedulerUnit(path, self.min_interval))
+
+        # Deepest units first, so the first matching unit is the most specific one
+        self.units.sort(key=lambda unit: len(unit.path), reverse=True)
+
+    def unit_for_path(self, path: str) -> typing.Union[CrawlSchedulerUnit, None]:
+        """ Returns the most specific unit which contains the path """
+        for unit in self.units:
+            if path.startswith(unit.path + '/'):
+                return unit
+
+        return None
+
+    def excluded_subtrees(self, unit: CrawlSchedulerUnit) -> list[str]:
+        """ Returns the paths of all units below the given unit: they are crawled on their own schedule """
+        return [other.path for other in self.units if other.path.startswith(unit.path + '/')]
+
+    def record_change(self, path: str):
+        """ A watcher handled a change of this path """
+        unit = self.unit_for_path(path)
+        if unit is not None:
+            unit.watched_changes += 1
+
+    def record_crawl(self, unit: CrawlSchedulerUnit, paths: int, changes: int):
+        """ The unit was crawled: learn its cost and change rate and calculate its next run """
+        now = time.time()
+
+        if unit.last_crawl is not None:
+            rate = (changes + unit.watched_changes) / max(1.0, now - unit.last_crawl)
+            if unit.rate is None:
+                unit.rate = rate
+            else:
+                unit.rate = (unit.rate + rate) / 2
+
+        unit.cost = paths
+        unit.last_crawl = now
+        unit.watched_changes = 0
+        unit.interval = self.interval_for_rate(unit.rate)
+        unit.next_run = now + unit.interval
+
+    def interval_for_rate(self, rate: typing.Union[float, None]) -> float:
+        """ Crawl a unit about as often as one change is expected in it """
+        if rate is None:
+            return self.min_interval
+
+        if rate <= 0:
+            return self.max_interval
+
+        return min(self.max_interval, max(self.min_interval, 1 / rate))
+
+    def due_units(self) -> list[CrawlSchedulerUnit]:
+        """ Returns the units that should be crawled now (within the I/O budget) and logs the decisions """
+        now = time.time()
+
+        due = []
+        for unit in self.units:
+            next_run = unit.next_run
+            if unit.last_crawl is not None and unit.watched_changes > 0:
+                # The watchers saw changes since the last crawl: the unit may be hotter than we thought
+                watched_rate = unit.watched_changes / max(1.0, now - unit.last_crawl)
+                if unit.rate is None or watched_rate > unit.rate:
+                    next_run = min(next_run, unit.last_crawl + self.interval_for_rate(watched_rate))
+
+            if next_run <= now:
+                due.append((now - next_run, unit))
+            else:
+                self.logger.info(
+                    'Scheduler: skipping "%s", next crawl in %.1f min(s) (interval %.1f min(s), %d watched change(s)).' % (
+                        unit.path,
+                        (next_run - now) / 60,
+                        unit.interval / 60,
+                        unit.watched_changes
+                    )
+                )
+
+        # The most overdue units first
+        due.sort(key=lambda entry: entry[0], reverse=True)
+
+        selected = []
+        budget_used = 0
+        for overdue, unit in due:
+            if self.io_budget > 0 and len(selected) > 0 and budget_used + unit.cost > self.io_budget:
+                self.logger.info(
+                    'Scheduler: deferring "%s" (overdue by %.1f min(s)), estimated %d paths exceed the I/O budget (%d / %d).' % (
+                        unit.path,
+                        overdue / 60,
+                        unit.cost,
+                        budget_used,
+                        self.io_budget
+                    )
+                )
+                continue
+
+            budget_used += unit.cost
+            selected.append(unit)
+
+            if unit.last_crawl is None:
+                self.logger.info('Scheduler: crawling "%s" (never crawled before).' % unit.path)
+                continue
+
+            self.logger.info(
+                'Scheduler: crawling "%s" (overdue by %.1f min(s), interval %.1f min(s), estimated %d paths).' % (
+                    unit.path,
+                    overdue / 60,
+                    unit.interval / 60,
+                    unit.cost
+                )
+            )
+
+        return selected
+
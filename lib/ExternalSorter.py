@@ -0,0 +1,72 @@
+#-*- coding: utf-8 -*-
+
+import heapq
+import json
+import os
+import tempfile
+import typing
+
+
+class ExternalSorter(object):
+    """
+    Sorts a stream of strings with bounded memory
+
+    At most buffer_size strings are held in RAM. If the stream is longer, the sorted chunks ("runs") are spilled to
+    temporary files and merged afterwards.
+    """
+
+    def __init__(self, buffer_size: int, directory: typing.Union[str, None], logger):
+        self.buffer_size = buffer_size
+        self.directory = directory
+        self.logger = logger
+
+    def sort(self, strings: typing.Iterable[str]) -> typing.Iterator[str]:
+        """ Yields the given strings in sorted order, duplicates are yielded only once """
+
+        runs = []
+        buffer = []
+        try:
+            for string in strings:
+                buffer.append(string)
+                if len(buffer) >= self.buffer_size:
+                    runs.append(self.spill(buffer))
+                    buffer = []
+
+            buffer.sort()
+
+            if len(runs) == 0:
+                # Everything fits into the buffer
+                sorted_strings = buffer
+            else:
+                self.logger.debug('Merging %d sorted run(s) and %d buffered string(s) ...' % (len(runs), len(buffer)))
+                sorted_strings = heapq.merge(buffer, *[self.read_run(run) for run in runs])
+
+            previous = None
+            for string in sorted_strings:
+                if string != previous:
+                    yield string
+                    previous = string
+        finally:
+            for run in runs:
+                run.close()
+
+    def spill(self, buffer: list[str]) -> typing.IO:
+        """ Writes the sorted buffer into a temporary file and returns it """
+        buffer.sort()
+
+        # The file is deleted as soon as it is closed
+        run = tempfile.TemporaryFile(mode='w+', encoding='utf-8', dir=self.directory)
+        for string in buffer:
+            # JSON keeps newlines and undecodable characters in paths intact
+            run.write(json.dumps(string))
+            run.write('\n')
+
+        run.seek(0)
+        self.logger.debug('Spilled a sorted run of %d string(s) to disk.' % len(buffer))
+        return run
+
+    @staticmethod
+    def read_run(run: typing.IO) -> typing.Iterator[str]:
+        """ Reads a spilled run """
+        for line in run:
+            yield json.loads(line)
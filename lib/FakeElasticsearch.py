@@ -0,0 +1,183 @@
+#-*- coding: utf-8 -*-
+
+import http.server
+import json
+import os
+import re
+import threading
+import typing
+import urllib.parse
+
+
+class FakeElasticsearch(object):
+    """
+    A local in-memory stand-in for elasticsearch, just enough for the changes watchers
+
+    It speaks HTTP like elasticsearch does, so the real elasticsearch client is used. It supports indexing and
+    deleting single documents, the bulk API and the search of the paths below a path (see Fs2EsIndexer.rename_path()).
+    Every received operation is reported to the callback as ('index' or 'delete', document ID).
+    """
+
+    def __init__(self, operation_callback: typing.Callable[[str, str], None]):
+        self.operation_callback = operation_callback
+        self.documents = {}
+        # The document IDs by the directory of their path, so the search doesn't have to scan all documents
+        self.children = {}
+        self.documents_lock = threading.Lock()
+        self.server = None
+
+    def start(self) -> str:
+        """ Starts the server on a random local port and returns its URL """
+
+        fake = self
+
+        class RequestHandler(http.server.BaseHTTPRequestHandler):
+            # Keep the connections of the elasticsearch client alive, without waiting for delayed ACKs between the
+            # headers and the body of a response
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                self.handle_request()
+
+            def do_POST(self):
+                self.handle_request()
+
+            def do_PUT(self):
+                self.handle_request()
+
+            def do_DELETE(self):
+                self.handle_request()
+
+            def handle_request(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                path = urllib.parse.urlparse(self.path).path
+                status, response = fake.handle(self.command, [urllib.parse.unquote(part) for part in path.strip('/').split('/')], body)
+
+                response = json.dumps(response).encode('utf-8')
+                self.send_response(status)
+                # The client refuses to talk to anything else than elasticsearch
+                self.send_header('X-Elastic-Product', 'Elasticsearch')
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RequestHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name='fake-elasticsearch', daemon=True).start()
+
+        return 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def stop(self):
+        """ Stops the server """
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def handle(self, method: str, path: list[str], body: bytes) -> tuple[int, dict]:
+        """ Handles a request and returns its status and response """
+
+        if method == 'GET' and path == ['']:
+            return 200, {'version': {'number': '8.0.0'}, 'tagline': 'You Know, for Search'}
+
+        if path[-1] == '_bulk':
+            return 200, self.handle_bulk(body)
+
+        if path[-1] == '_search':
+            return 200, self.handle_search(path[0], json.loads(body) if body else {})
+
+        if len(path) == 3 and path[1] == '_doc':
+            index, document_id = path[0], path[2]
+            if method in ('PUT', 'POST'):
+                self.index_document(document_id, json.loads(body))
+                return 200, {'_index': index, '_id': document_id, 'result': 'created'}
+
+            if method == 'DELETE':
+                if self.delete_document(document_id):
+                    return 200, {'_index': index, '_id': document_id, 'result': 'deleted'}
+                return 404, {'_index': index, '_id': document_id, 'result': 'not_found'}
+
+        return 400, {'error': {'type': 'illegal_argument_exception', 'reason': 'Not supported: %s /%s' % (method, '/'.join(path))}, 'status': 400}
+
+    def handle_bulk(self, body: bytes) -> dict:
+        """ Executes the index and delete operations of a bulk request """
+
+        items = []
+        lines = iter([line for line in body.split(b'\n') if line.strip()])
+        for line in lines:
+            operation, metadata = list(json.loads(line).items())[0]
+            document_id = metadata['_id']
+
+            if operation in ('index', 'create'):
+                self.index_document(document_id, json.loads(next(lines)))
+                items.append({operation: {'_id': document_id, 'status': 201, 'result': 'created'}})
+            elif operation == 'delete':
+                if self.delete_document(document_id):
+                    items.append({operation: {'_id': document_id, 'status': 200, 'result': 'deleted'}})
+                else:
+                    items.append({operation: {'_id': document_id, 'status': 404, 'result': 'not_found'}})
+            else:
+                # The update operation is followed by its document too
+                next(lines)
+                items.append({operation: {'_id': document_id, 'status': 400, 'error': {'type': 'illegal_argument_exception'}}})
+
+        return {'took': 1, 'errors': any(item[operation]['status'] >= 300 for item in items for operation in item), 'items': items}
+
+    def handle_search(self, index: str, body: dict) -> dict:
+        """ Returns the documents below the path of a 'path.real.fulltext: "<path>"' query """
+
+        query = body.get('query', {}).get('query_string', {}).get('query', '')
+        re_match = re.search(r'path\.real\.fulltext\s*:\s*"((?:[^"\\]|\\.)*)"', query)
+
+        hits = []
+        if re_match:
+            path = re_match.group(1).rstrip('/')
+            with self.documents_lock:
+                # The path itself and everything below it
+                for document_id in self.children.get(os.path.dirname(path), ()):
+                    if self.documents[document_id]['path']['real'] == path:
+                        hits.append({'_index': index, '_id': document_id, '_score': 1.0, '_source': self.documents[document_id]})
+
+                directories = [path]
+                while len(directories) > 0:
+                    for document_id in self.children.get(directories.pop(), ()):
+                        document = self.documents[document_id]
+                        hits.append({'_index': index, '_id': document_id, '_score': 1.0, '_source': document})
+                        directories.append(document['path']['real'])
+
+        size = body.get('size', 10)
+        return {
+            'took': 1,
+            'timed_out': False,
+            'hits': {'total': {'value': len(hits), 'relation': 'eq'}, 'max_score': 1.0, 'hits': hits[:size]}
+        }
+
+    def index_document(self, document_id: str, document: dict, report: bool = True):
+        """ Stores the document, report=False indexes it silently (e. g. to prepare a benchmark) """
+        with self.documents_lock:
+            self.remove_document(document_id)
+            self.documents[document_id] = document
+            self.children.setdefault(os.path.dirname(document['path']['real']), set()).add(document_id)
+
+        if report:
+            self.operation_callback('index', document_id)
+
+    def delete_document(self, document_id: str) -> bool:
+        with self.documents_lock:
+            found = self.remove_document(document_id)
+
+        self.operation_callback('delete', document_id)
+        return found
+
+    def remove_document(self, document_id: str) -> bool:
+        """ Removes the document (the caller holds the lock), returns False if it didn't exist """
+        document = self.documents.pop(document_id, None)
+        if document is None:
+            return False
+
+        self.children.get(os.path.dirname(document['path']['real']), set()).discard(document_id)
+        return True
@@ -8,11 +8,17 @@ import itertools
 import json
 import logging
 import os
+import queue
 import re
+import threading
 import time
 import typing
 
 from lib.ChangesWatcher.AuditLogChangesWatcher import *
+from lib.CrawlGovernor import *
+from lib.CrawlScheduler import *
+from lib.ExternalSorter import *
+from lib.WriteAheadSpool import *
 try:
     from lib.ChangesWatcher.FanotifyChangesWatcher import *
 except:
@@ -24,6 +30,9 @@ except:
 class Fs2EsIndexer(object):
     """ Indexes filenames and directory names into an ElasticSearch index ready for spotlight search via Samba 4 """
 
+    # Elasticsearch is (temporarily) unavailable or overloaded: the operations are spooled and retried later
+    ELASTICSEARCH_UNAVAILABLE_STATUSES = (429, 502, 503, 504)
+
     def __init__(self, config: dict[str, typing.Any], logger):
         """ Constructor """
 
@@ -33,28 +42,24 @@ class Fs2EsIndexer(object):
         self.dump_documents_on_error = config.get('dump_documents_on_error', False)
 
         self.daemon_wait_time = config.get('wait_time', '30m')
-        re_match = re.match(r'^(\d+)(\w)$', self.daemon_wait_time)
-        if re_match:
-            suffix = re_match.group(2)
-            if suffix == 's':
-                self.daemon_wait_seconds = int(re_match.group(1))
-            elif suffix == 'm':
-                self.daemon_wait_seconds = int(re_match.group(1)) * 60
-            elif suffix == 'h':
-                self.daemon_wait_seconds = int(re_match.group(1)) * 60 * 60
-            elif suffix == 'd':
-                self.daemon_wait_seconds = int(re_match.group(1)) * 60 * 60 * 24
-            else:
-                self.logger.info('Unknown time unit in "wait_time": %s, expected "s", "m", "h" or "d"' % suffix)
-                exit(1)
-        else:
-            self.logger.info('Unknown "wait_time": %s' % self.daemon_wait_time)
-            exit(1)
+        self.daemon_wait_seconds = self.parse_duration(self.daemon_wait_time, 'wait_time')
 
         exclusions = config.get('exclusions', {})
         self.exclusion_strings = exclusions.get('partial_paths', [])
         self.exclusion_reg_exps = exclusions.get('regular_expressions', [])
 
+        # Crawl only the subtrees the changes watcher saw changes in, with a full indexing run every N runs
+        dirty_subtrees_config = config.get('dirty_subtrees', None)
+        self.dirty_subtrees_enabled = dirty_subtrees_config is not None
+        if dirty_subtrees_config is None:
+            dirty_subtrees_config = {}
+        # 0: never do a full indexing run (besides the first one)
+        self.dirty_subtrees_full_index_every = dirty_subtrees_config.get('full_index_every', 12)
+        if type(self.dirty_subtrees_full_index_every) is not int or self.dirty_subtrees_full_index_every < 0:
+            self.logger.error('Invalid "dirty_subtrees:full_index_every": %s, expected a number >= 0' % self.dirty_subtrees_full_index_every)
+            exit(1)
+        self.dirty_subtrees_max_directories = dirty_subtrees_config.get('max_directories', 10000)
+
         if config.get('use_fanotify', False):
             try:
                 self.changes_watcher = FanotifyChangesWatcher(self)
@@ -63,19 +68,33 @@ class Fs2EsIndexer(object):
                 exit(1)
         else:
             self.changes_watcher = AuditLogChangesWatcher(self, config.get('samba', {}))
+        # Only the daemon starts the changes watcher
+        self.changes_watcher_active = False
 
         elasticsearch_config = config.get('elasticsearch', {})
         self.elasticsearch_url = elasticsearch_config.get('url', 'http://localhost:9200')
         self.elasticsearch_index = elasticsearch_config.get('index', 'files')
         self.elasticsearch_bulk_size = elasticsearch_config.get('bulk_size', 10000)
         self.index_file_dates = elasticsearch_config.get('index_file_dates', False)
+        self.elasticsearch_use_alias = elasticsearch_config.get('use_alias', False)
+        self.elasticsearch_rebuild_alias = None
+        # Set once an indexing run filled the new index, its swap may only wait for the spool then
+        self.elasticsearch_rebuild_filled = False
+
+        # "default": file.filename is a text field, "substring": file.filename is a wildcard field for *term* queries
+        self.elasticsearch_mapping_profile = elasticsearch_config.get('mapping_profile', 'default')
+        if self.elasticsearch_mapping_profile not in ('default', 'substring'):
+            self.logger.info('Unknown "elasticsearch:mapping_profile": %s, expected "default" or "substring"' % self.elasticsearch_mapping_profile)
+            exit(1)
 
-        elasticsearch_index_mapping_file = elasticsearch_config.get('index_mapping', '/etc/fs2es-indexer/es-index-mapping.json')
-        with open(elasticsearch_index_mapping_file, 'r') as f:
+        # The mapping file of the "default" profile, the other profiles are next to it
+        self.elasticsearch_index_mapping_file = elasticsearch_config.get('index_mapping', '/etc/fs2es-indexer/es-index-mapping.json')
+        with open(self.mapping_profile_file(self.elasticsearch_index_mapping_file, self.elasticsearch_mapping_profile), 'r') as f:
             self.elasticsearch_expected_index_mapping = json.load(f)
 
-        elasticsearch_index_settings_file = elasticsearch_config.get('index_settings', '/etc/fs2es-indexer/es-index-settings.json')
-        with open(elasticsearch_index_settings_file, 'r') as f:
+        # The settings file of the "default" profile, the other profiles are next to it
+        self.elasticsearch_index_settings_file = elasticsearch_config.get('index_settings', '/etc/fs2es-indexer/es-index-settings.json')
+        with open(self.mapping_profile_file(self.elasticsearch_index_settings_file, self.elasticsearch_mapping_profile), 'r') as f:
             self.elasticsearch_expected_index_settings = json.load(f)
 
         if 'user' in elasticsearch_config:
@@ -93,13 +112,122 @@ class Fs2EsIndexer(object):
             ca_certs = elasticsearch_config.get('ca_certs', None)
         )
 
+        spool_config = config.get('spool', None)
+        self.spool_locked = False
+        if spool_config is not None:
+            self.spool = WriteAheadSpool(spool_config, self.logger)
+            try:
+                if not self.spool.open():
+                    # Don't replay (and truncate) the spool while the other process appends to it
+                    self.logger.info(
+                        'The spool "%s" is locked by another process (e. g. the daemon), continuing without it.' % self.spool.path
+                    )
+                    self.spool = None
+                    self.spool_locked = True
+            except OSError as err:
+                self.logger.error('Failed to open the spool "%s": %s' % (self.spool.path, str(err)))
+                exit(1)
+        else:
+            self.spool = None
+
+        scheduler_config = config.get('scheduler', None)
+        if scheduler_config is not None:
+            self.scheduler = CrawlScheduler(
+                self.directories,
+                scheduler_config,
+                self.parse_duration(scheduler_config.get('min_interval', self.daemon_wait_time), 'scheduler:min_interval'),
+                self.parse_duration(scheduler_config.get('max_interval', '1d'), 'scheduler:max_interval'),
+                self.logger
+            )
+        else:
+            self.scheduler = None
+
+        # Track the directories (device and inode) a crawl visited, so overlapping directories, bind mounts and loops
+        # are only crawled once
+        crawl_config = config.get('crawl', None)
+        self.crawl_track_directories = crawl_config is not None
+        if crawl_config is None:
+            crawl_config = {}
+        self.crawl_duplicate_directories = crawl_config.get('duplicate_directories', 'index')
+        if self.crawl_duplicate_directories not in ('index', 'skip'):
+            self.logger.info('Unknown "crawl:duplicate_directories": %s, expected "index" or "skip"' % self.crawl_duplicate_directories)
+            exit(1)
+        self.crawl_one_file_system = crawl_config.get('one_file_system', False)
+
+        # Limit the I/O of the crawls (but not of the changes watchers), with shares the pool shares one governor
+        governor_config = config.get('crawl_governor', None)
+        if governor_config is not None:
+            self.crawl_governor = CrawlGovernor(governor_config, self.logger)
+        else:
+            self.crawl_governor = None
+        # How long the governor paused the crawl and how many filesystem changes were handled meanwhile
+        self.duration_crawl_paused = 0
+        self.crawl_watched_changes = 0
+
+        reconciliation_config = config.get('reconciliation', {})
+        self.reconciliation_mode = reconciliation_config.get('mode', 'memory')
+        if self.reconciliation_mode not in ('memory', 'sorted_merge'):
+            self.logger.info('Unknown "reconciliation:mode": %s, expected "memory" or "sorted_merge"' % self.reconciliation_mode)
+            exit(1)
+
+        self.sorter = ExternalSorter(
+            reconciliation_config.get('sort_buffer_size', 1000000),
+            reconciliation_config.get('sort_directory', None),
+            self.logger
+        )
+
+        # The document IDs in RAM are only used by full indexing runs in the "memory" reconciliation mode, in all
+        # other modes they'd just grow with every change of the watchers
         self.elasticsearch_document_ids = {}
+        self.track_document_ids = self.reconciliation_mode == 'memory' and self.scheduler is None
         self.duration_elasticsearch = 0
 
+        # The state of the daemon, queried via the control socket
+        self.status_lock = threading.Lock()
+        self.phase = 'starting'
+        self.phase_started = time.time()
+        self.phase_stats = {}
+        self.progress_paths_crawled = 0
+        self.last_indexing_run = None
+
+        # Commands of the control socket, executed by the daemon between its work steps
+        self.control_commands = queue.Queue()
+        self.crawl_resumed = threading.Event()
+        self.crawl_resumed.set()
+
     @staticmethod
     def format_count(count):
         return '{:,}'.format(count).replace(',', ' ')
 
+    @staticmethod
+    def mapping_profile_file(default_mapping_file: str, profile: str) -> str:
+        """ Returns the mapping (or settings) file of the profile, e. g. es-index-mapping-substring.json for "substring" """
+        if profile == 'default':
+            return default_mapping_file
+
+        mapping_file, extension = os.path.splitext(default_mapping_file)
+        return '%s-%s%s' % (mapping_file, profile, extension)
+
+    def parse_duration(self, duration: str, config_key: str) -> int:
+        """ Parses a duration like "30s", "5m", "2h" or "1d" into seconds """
+        re_match = re.match(r'^(\d+)(\w)$', duration)
+        if re_match:
+            suffix = re_match.group(2)
+            if suffix == 's':
+                return int(re_match.group(1))
+            elif suffix == 'm':
+                return int(re_match.group(1)) * 60
+            elif suffix == 'h':
+                return int(re_match.group(1)) * 60 * 60
+            elif suffix == 'd':
+                return int(re_match.group(1)) * 60 * 60 * 24
+            else:
+                self.logger.info('Unknown time unit in "%s": %s, expected "s", "m", "h" or "d"' % (config_key, suffix))
+                exit(1)
+        else:
+            self.logger.info('Unknown "%s": %s' % (config_key, duration))
+            exit(1)
+
     def elasticsearch_map_path_to_document(self, path: str, filename: str) -> typing.Union[dict, None]:
         """ Maps a file or directory path to an elasticsearch document """
 
@@ -133,29 +261,164 @@ class Fs2EsIndexer(object):
     def elasticsearch_bulk_action(self, documents):
         """ Imports documents into elasticsearch or deletes documents from there """
 
-        # See https://elasticsearch-py.readthedocs.io/en/v8.6.2/helpers.html#bulk-helpers
+        if self.spool is not None and self.spool.has_pending():
+            # Keep the order of all operations: the spooled ones must be sent first
+            if not self.spool.replay_due() or not self.elasticsearch_replay_spool():
+                self.spool.append(documents)
+                return
 
         start_time = time.time()
         try:
-            elasticsearch.helpers.bulk(self.elasticsearch, documents, index=self.elasticsearch_index)
+            self.elasticsearch_send_bulk(documents)
         except Exception as err:
             self.logger.info(
                 'Failed to bulk import/delete documents into elasticsearch "%s": %s' % (self.elasticsearch_url, str(err))
             )
 
-            if self.dump_documents_on_error:
-                filename = '/tmp/fs2es-indexer-failed-documents-%s.json' % datetime.datetime.now().strftime("%Y-%m-%d_%H_%M_%S")
-                with open(filename, 'w') as f:
-                    json.dump(documents, f)
+            if self.spool is not None and self.elasticsearch_is_unavailable(err):
+                if isinstance(err, elasticsearch.helpers.BulkIndexError):
+                    # Only some documents failed: drop the ones elasticsearch rejected for good, spool the rest
+                    # (including the successful ones, replaying them is harmless and keeps the order)
+                    rejected_ids = self.elasticsearch_rejected_ids(err)
+                    if len(rejected_ids) > 0:
+                        rejected_documents = [document for document in documents if document['_id'] in rejected_ids]
+                        self.logger.error(
+                            'Elasticsearch "%s" rejected %d document(s): %s' % (
+                                self.elasticsearch_url,
+                                len(rejected_documents),
+                                str([error for error in err.errors if self.elasticsearch_error_id(error) in rejected_ids][:10])
+                            )
+                        )
+                        self.dump_failed_documents(rejected_documents)
+                        documents = [document for document in documents if document['_id'] not in rejected_ids]
 
-                self.logger.error(
-                    'Dumped the failed documents to %s, please review it and report bugs upstream.' % filename
+                self.logger.info(
+                    'Spooling %d operation(s) to "%s" until elasticsearch is available again.' % (
+                        len(documents),
+                        self.spool.path
+                    )
                 )
+                self.spool.append(documents)
+                return
 
+            self.dump_failed_documents(documents)
             exit(1)
 
         self.duration_elasticsearch += time.time() - start_time
 
+    def elasticsearch_send_bulk(self, documents):
+        """ Sends the documents via the bulk API, a delete of an already deleted document is not an error """
+
+        # See https://elasticsearch-py.readthedocs.io/en/v8.6.2/helpers.html#bulk-helpers
+        success, errors = elasticsearch.helpers.bulk(
+            self.elasticsearch,
+            documents,
+            index=self.elasticsearch_index,
+            raise_on_error=False
+        )
+
+        errors = [error for error in errors if error.get('delete', {}).get('status', 500) != 404]
+        if len(errors) > 0:
+            raise elasticsearch.helpers.BulkIndexError('%d document(s) failed.' % len(errors), errors)
+
+    def elasticsearch_replay_spool(self) -> bool:
+        """ Sends all spooled operations to elasticsearch, returns True if the spool is empty afterwards """
+
+        if self.spool is None or not self.spool.has_pending():
+            return True
+
+        start_time = time.time()
+        try:
+            self.spool.replay(self.elasticsearch_bulk_size, self.elasticsearch_replay_bulk)
+        except Exception as err:
+            if not self.elasticsearch_is_unavailable(err):
+                raise
+
+            self.logger.info(
+                'Elasticsearch "%s" is still unavailable, %d operation(s) remain spooled: %s' % (
+                    self.elasticsearch_url,
+                    self.spool.records_pending,
+                    str(err)
+                )
+            )
+            return False
+
+        self.duration_elasticsearch += time.time() - start_time
+        return True
+
+    def elasticsearch_replay_bulk(self, documents):
+        """ Sends a chunk of spooled operations, documents rejected by elasticsearch must not block the spool """
+        try:
+            self.elasticsearch_send_bulk(documents)
+        except elasticsearch.helpers.BulkIndexError as err:
+            if self.elasticsearch_is_unavailable(err):
+                # e. g. the shards aren't assigned yet after a restart: keep the spool and try again later
+                raise
+
+            self.logger.error(
+                'Elasticsearch "%s" rejected %d spooled document(s): %s' % (
+                    self.elasticsearch_url,
+                    len(err.errors),
+                    str(err.errors[:10])
+                )
+            )
+            self.dump_failed_documents(documents)
+
+    @staticmethod
+    def elasticsearch_is_unavailable(err: Exception) -> bool:
+        """ Tests if the error means that elasticsearch is (temporarily) unavailable """
+        if isinstance(err, (elasticsearch.exceptions.ConnectionError, elasticsearch.exceptions.ConnectionTimeout)):
+            return True
+
+        if isinstance(err, elasticsearch.exceptions.ApiError):
+            return err.status_code in Fs2EsIndexer.ELASTICSEARCH_UNAVAILABLE_STATUSES
+
+        if isinstance(err, elasticsearch.helpers.BulkIndexError):
+            # The bulk request succeeded, but some of its documents failed temporarily (e. g. 503 unavailable_shards_exception)
+            return any(
+                Fs2EsIndexer.elasticsearch_error_status(error) in Fs2EsIndexer.ELASTICSEARCH_UNAVAILABLE_STATUSES
+                for error in err.errors
+            )
+
+        return False
+
+    @staticmethod
+    def elasticsearch_error_status(error: dict) -> int:
+        """ Returns the status of a failed document of a bulk request, e. g. {"index": {"_id": ..., "status": 503}} """
+        return list(error.values())[0].get('status', 500)
+
+    @staticmethod
+    def elasticsearch_error_id(error: dict) -> str:
+        """ Returns the document ID of a failed document of a bulk request """
+        return list(error.values())[0].get('_id', None)
+
+    @staticmethod
+    def elasticsearch_rejected_ids(err: elasticsearch.helpers.BulkIndexError) -> set[str]:
+        """ Returns the IDs of the documents of a bulk request elasticsearch rejected for good (e. g. 400) """
+        rejected_ids = set()
+        unavailable_ids = set()
+        for error in err.errors:
+            if Fs2EsIndexer.elasticsearch_error_status(error) in Fs2EsIndexer.ELASTICSEARCH_UNAVAILABLE_STATUSES:
+                unavailable_ids.add(Fs2EsIndexer.elasticsearch_error_id(error))
+            else:
+                rejected_ids.add(Fs2EsIndexer.elasticsearch_error_id(error))
+
+        # Every operation on a document which failed temporarily is retried, so its order is kept
+        return rejected_ids - unavailable_ids
+
+    def dump_failed_documents(self, documents):
+        """ Dumps the documents to a file in /tmp if configured """
+        if not self.dump_documents_on_error:
+            return
+
+        filename = '/tmp/fs2es-indexer-failed-documents-%s.json' % datetime.datetime.now().strftime("%Y-%m-%d_%H_%M_%S")
+        with open(filename, 'w') as f:
+            json.dump(documents, f)
+
+        self.logger.error(
+            'Dumped the failed documents to %s, please review it and report bugs upstream.' % filename
+        )
+
     def elasticsearch_analyze_index(self):
         """
         Analyzes the elasticsearch index and reports back if it should be recreated
@@ -165,21 +428,34 @@ class Fs2EsIndexer(object):
         """
 
         if self.elasticsearch.indices.exists(index=self.elasticsearch_index):
-            actual_index_settings = self.elasticsearch.indices.get_settings(index=self.elasticsearch_index)
+            # If self.elasticsearch_index is an alias, the response contains the index behind it
+            actual_index_settings = list(self.elasticsearch.indices.get_settings(index=self.elasticsearch_index).values())[0]
 
-            self.logger.debug('Index settings: %s' % json.dumps(actual_index_settings[self.elasticsearch_index]))
+            self.logger.debug('Index settings: %s' % json.dumps(actual_index_settings))
 
             try:
-                self.is_dict_complete(self.elasticsearch_expected_index_settings, actual_index_settings[self.elasticsearch_index]['settings']['index'], 'settings')
+                self.is_dict_complete(self.elasticsearch_expected_index_settings, actual_index_settings['settings']['index'], 'settings')
             except ValueError as err:
                 self.logger.info(err)
                 return True
 
-            actual_index_mapping = self.elasticsearch.indices.get_mapping(index=self.elasticsearch_index)
+            actual_index_mapping = list(self.elasticsearch.indices.get_mapping(index=self.elasticsearch_index).values())[0]
             try:
-                self.is_dict_complete(self.elasticsearch_expected_index_mapping, actual_index_mapping[self.elasticsearch_index], 'mapping')
+                self.is_dict_complete(self.elasticsearch_expected_index_mapping, actual_index_mapping, 'mapping')
             except ValueError as err:
                 self.logger.info(err)
+
+                actual_filename_type = actual_index_mapping.get('mappings', {}).get('properties', {}).get('file', {}) \
+                    .get('properties', {}).get('filename', {}).get('type', None)
+                actual_profile = 'substring' if actual_filename_type == 'wildcard' else 'default'
+                if actual_profile != self.elasticsearch_mapping_profile:
+                    self.logger.info(
+                        'Index "%s" uses the mapping profile "%s", but "%s" is configured.' % (
+                            self.elasticsearch_index,
+                            actual_profile,
+                            self.elasticsearch_mapping_profile
+                        )
+                    )
                 return True
 
         return False
@@ -192,10 +468,17 @@ class Fs2EsIndexer(object):
         for the fields expected by samba and their mappings to the expected Spotlight results
         """
 
+        if self.elasticsearch_use_alias and not self.elasticsearch.indices.exists_alias(name=self.elasticsearch_index):
+            # Either there is no index at all or an old index without an alias: build a versioned index behind an alias
+            self.elasticsearch_rebuild_index()
+            return
+
         if self.elasticsearch.indices.exists(index=self.elasticsearch_index):
             recreate_necessary = self.elasticsearch_analyze_index()
 
-            if recreate_necessary:
+            if recreate_necessary and self.elasticsearch_use_alias:
+                self.elasticsearch_rebuild_index()
+            elif recreate_necessary:
                 self.delete_index()
 
                 self.logger.info('Recreating index "%s" ...' % self.elasticsearch_index)
@@ -213,6 +496,10 @@ class Fs2EsIndexer(object):
                 except elasticsearch.exceptions.BadRequestError as err:
                     self.logger.error('Failed to update index at elasticsearch "%s": %s' % (self.elasticsearch_url, str(err)))
 
+                    if self.elasticsearch_use_alias:
+                        self.elasticsearch_rebuild_index()
+                        return
+
                     self.logger.info('Deleting index "%s"...' % self.elasticsearch_index)
                     self.elasticsearch.indices.delete(index=self.elasticsearch_index)
 
@@ -225,12 +512,18 @@ class Fs2EsIndexer(object):
             self.logger.info('Creating index "%s" ...' % self.elasticsearch_index)
             self.elasticsearch_create_index()
 
-    def elasticsearch_create_index(self):
+    def elasticsearch_create_index(self, index: str = None, settings: dict = None):
+        if index is None:
+            index = self.elasticsearch_index
+
+        if settings is None:
+            settings = self.elasticsearch_expected_index_settings
+
         try:
             self.elasticsearch.indices.create(
-                index=self.elasticsearch_index,
+                index=index,
                 mappings=self.elasticsearch_expected_index_mapping['mappings'],
-                settings=self.elasticsearch_expected_index_settings
+                settings=settings
             )
         except elasticsearch.exceptions.ConnectionError as err:
             self.logger.error('Failed to connect to elasticsearch at "%s": %s' % (self.elasticsearch_url, str(err)))
@@ -239,6 +532,113 @@ class Fs2EsIndexer(object):
             self.logger.error('Failed to create index at elasticsearch "%s": %s' % (self.elasticsearch_url, str(err)))
             exit(1)
 
+    def elasticsearch_rebuild_index(self):
+        """
+        Creates a new versioned index which is filled by the next indexing run, see elasticsearch_finish_rebuild()
+
+        The old index stays searchable via the alias during the whole rebuild. While loading, the new index is not
+        refreshed, has no replicas and syncs its translog asynchronously.
+        """
+
+        alias = self.elasticsearch_index
+        new_index = '%s-%s' % (alias, datetime.datetime.now().strftime('%Y%m%d%H%M%S'))
+
+        # Remove leftovers of an aborted rebuild
+        old_indices = self.elasticsearch_indices_behind_alias()
+        for index in self.elasticsearch_versioned_indices():
+            if index not in old_indices:
+                self.logger.info('Deleting index "%s" of an aborted rebuild ...' % index)
+                self.elasticsearch.indices.delete(index=index)
+
+        self.logger.info('Creating index "%s" for alias "%s", it will be filled during the next indexing run ...' % (new_index, alias))
+
+        bulk_load_settings = dict(self.elasticsearch_expected_index_settings)
+        bulk_load_settings['refresh_interval'] = '-1'
+        bulk_load_settings['number_of_replicas'] = 0
+        bulk_load_settings['translog'] = {'durability': 'async'}
+        self.elasticsearch_create_index(new_index, bulk_load_settings)
+
+        # All operations go to the new (empty) index until the alias is swapped
+        self.elasticsearch_rebuild_alias = alias
+        self.elasticsearch_rebuild_filled = False
+        self.elasticsearch_index = new_index
+        self.elasticsearch_document_ids = {}
+
+    def elasticsearch_finish_rebuild(self):
+        """ Restores the settings of the rebuilt index, force merges it and swaps the alias over to it atomically """
+
+        if self.elasticsearch_rebuild_alias is None:
+            return
+
+        # Only called after an indexing run, so the new index is filled now
+        self.elasticsearch_rebuild_filled = True
+
+        alias = self.elasticsearch_rebuild_alias
+        new_index = self.elasticsearch_index
+
+        if self.spool is not None and self.spool.has_pending():
+            # The spooled operations must reach the new index before it's swapped in
+            self.logger.info('Operations for index "%s" are still spooled, postponing the swap of alias "%s".' % (new_index, alias))
+            return
+
+        self.logger.info('Restoring the settings of index "%s" ...' % new_index)
+        self.elasticsearch.indices.put_settings(
+            index=new_index,
+            settings={
+                'refresh_interval': self.elasticsearch_expected_index_settings.get('refresh_interval', None),
+                'number_of_replicas': self.elasticsearch_expected_index_settings.get('number_of_replicas', None),
+                'translog': {
+                    'durability': self.elasticsearch_expected_index_settings.get('translog', {}).get('durability', None)
+                }
+            }
+        )
+        self.elasticsearch.indices.refresh(index=new_index)
+
+        self.logger.info('Force merging index "%s" ...' % new_index)
+        try:
+            self.elasticsearch.options(request_timeout=3600).indices.forcemerge(index=new_index, max_num_segments=1)
+        except Exception as err:
+            # The index is usable anyway, the merge is just an optimization
+            self.logger.info('Failed to force merge index "%s": %s' % (new_index, str(err)))
+
+        old_indices = self.elasticsearch_indices_behind_alias(alias)
+        actions = [{'add': {'index': new_index, 'alias': alias}}]
+        for index in old_indices:
+            actions.append({'remove': {'index': index, 'alias': alias}})
+        if len(old_indices) == 0 and self.elasticsearch.indices.exists(index=alias):
+            # An old index with the name of the alias must be deleted in the same (atomic) step
+            actions.append({'remove_index': {'index': alias}})
+
+        self.logger.info('Swapping alias "%s" to index "%s" ...' % (alias, new_index))
+        self.elasticsearch.indices.update_aliases(actions=actions)
+
+        self.elasticsearch_index = alias
+        self.elasticsearch_rebuild_alias = None
+        self.elasticsearch_rebuild_filled = False
+
+        for index in old_indices:
+            self.logger.info('Deleting old index "%s" ...' % index)
+            self.elasticsearch.indices.delete(index=index)
+
+    def elasticsearch_rebuild_pending(self) -> bool:
+        """ Returns True if the new index of a rebuild still needs a full indexing run """
+        return self.elasticsearch_rebuild_alias is not None and not self.elasticsearch_rebuild_filled
+
+    def elasticsearch_indices_behind_alias(self, alias: str = None) -> list[str]:
+        """ Returns the names of the indices behind the alias """
+        if alias is None:
+            alias = self.elasticsearch_index
+
+        try:
+            return list(self.elasticsearch.indices.get_alias(name=alias).keys())
+        except elasticsearch.exceptions.NotFoundError:
+            return []
+
+    def elasticsearch_versioned_indices(self) -> list[str]:
+        """ Returns the names of all versioned indices built for our alias """
+        indices = self.elasticsearch.indices.get(index='%s-*' % self.elasticsearch_index, expand_wildcards='open,closed')
+        return [index for index in indices.keys() if re.match(r'^%s-\d{14}$' % re.escape(self.elasticsearch_index), index)]
+
     def elasticsearch_refresh_index(self):
         """ Refresh the elasticsearch index """
 
@@ -249,6 +649,9 @@ class Fs2EsIndexer(object):
             self.duration_elasticsearch += time.time() - start_time
         except elasticsearch.exceptions.ConnectionError as err:
             self.logger.error('Failed to connect to elasticsearch at "%s": %s' % (self.elasticsearch_url, str(err)))
+            if self.spool is not None:
+                # The following operations will be spooled
+                return
             exit(1)
         except Exception as err:
             self.logger.error(
@@ -263,6 +666,11 @@ class Fs2EsIndexer(object):
     def index_directories(self):
         """ Imports the content of the directories and all of its subdirectories into the elasticsearch index """
 
+        if self.reconciliation_mode == 'sorted_merge':
+            if self.index_directories_sorted_merge():
+                self.elasticsearch_finish_rebuild()
+            return
+
         # Copy the document IDs to _old and create a new
         elasticsearch_document_ids_old = self.elasticsearch_document_ids
         self.elasticsearch_document_ids = {}
@@ -272,53 +680,54 @@ class Fs2EsIndexer(object):
         documents_to_be_indexed = 0
         documents_indexed = 0
         self.duration_elasticsearch = 0
+        self.duration_crawl_paused = 0
+        self.crawl_watched_changes = 0
         start_time = round(time.time())
 
         self.logger.info('Starting to index the files and directories ...')
 
+        # Shared by all directories, so overlapping directories are crawled only once
+        visited_directories = {}
         for directory in self.directories:
             self.logger.info('- Starting to index directory "%s" ...' % directory)
 
-            for root, dirs, files in os.walk(directory):
-                for name in itertools.chain(files, dirs):
-                    full_path = os.path.join(root, name)
-                    if self.path_should_be_indexed(full_path, False):
-                        document = self.elasticsearch_map_path_to_document(
-                            path=full_path,
-                            filename=name
-                        )
-
-                        if document is None:
-                            continue
-
-                        paths_total += 1
+            for full_path, name in self.crawl_directory(directory, visited_directories=visited_directories, throttle=True):
+                document = self.elasticsearch_map_path_to_document(
+                    path=full_path,
+                    filename=name
+                )
 
-                        # TODO Update of last_modified date if self.index_file_dates is true
-                        if document['_id'] not in elasticsearch_document_ids_old:
-                            # Only add _new_ files and dirs to the index
-                            documents.append(document)
-                            documents_to_be_indexed += 1
-
-                            if documents_to_be_indexed >= self.elasticsearch_bulk_size:
-                                self.elasticsearch_bulk_action(documents)
-
-                                documents = []
-                                documents_indexed += documents_to_be_indexed
-                                documents_to_be_indexed = 0
-                                self.logger.info(
-                                    '- %s paths indexed, elasticsearch import lasted %.2f / %.2f min(s)' % (
-                                        self.format_count(documents_indexed),
-                                        self.duration_elasticsearch / 60,
-                                        (time.time() - start_time) / 60
-                                    )
-                                )
+                if document is None:
+                    continue
+
+                paths_total += 1
+
+                # TODO Update of last_modified date if self.index_file_dates is true
+                if document['_id'] not in elasticsearch_document_ids_old:
+                    # Only add _new_ files and dirs to the index
+                    documents.append(document)
+                    documents_to_be_indexed += 1
+
+                    if documents_to_be_indexed >= self.elasticsearch_bulk_size:
+                        self.elasticsearch_bulk_action(documents)
+
+                        documents = []
+                        documents_indexed += documents_to_be_indexed
+                        documents_to_be_indexed = 0
+                        self.logger.info(
+                            '- %s paths indexed, elasticsearch import lasted %.2f / %.2f min(s)' % (
+                                self.format_count(documents_indexed),
+                                self.duration_elasticsearch / 60,
+                                (time.time() - start_time) / 60
+                            )
+                        )
 
-                        try:
-                            del elasticsearch_document_ids_old[document['_id']]
-                        except:
-                            pass
+                try:
+                    del elasticsearch_document_ids_old[document['_id']]
+                except:
+                    pass
 
-                        self.elasticsearch_document_ids[document['_id']] = 1
+                self.elasticsearch_document_ids[document['_id']] = 1
 
             self.logger.info('- Indexing of directory "%s" done.' % directory)
 
@@ -340,7 +749,8 @@ class Fs2EsIndexer(object):
         old_document_count = len(elasticsearch_document_ids_old)
         if old_document_count > 0:
             # Refresh the index before each delete
-            self.elasticsearch_refresh_index()
+            if self.spool is None or not self.spool.has_pending():
+                self.elasticsearch_refresh_index()
 
             # Delete every document in elasticsearch_document_ids_old
             # because the crawler didnt find them during the last run!
@@ -355,19 +765,7 @@ class Fs2EsIndexer(object):
             start_index = 0
             end_index = self.elasticsearch_bulk_size
             while start_index < old_document_count:
-                temp_list = elasticsearch_document_ids_old_list[start_index:end_index]
-
-                delete_start_time = time.time()
-                self.elasticsearch.delete_by_query(
-                    index=self.elasticsearch_index,
-                    query={
-                        "terms": {
-                            "_id": temp_list
-                        }
-                    }
-                )
-
-                self.duration_elasticsearch += time.time() - delete_start_time
+                self.elasticsearch_delete_documents(elasticsearch_document_ids_old_list[start_index:end_index])
 
                 self.logger.info(
                     '- %s / %s documents deleted.' % (
@@ -384,6 +782,492 @@ class Fs2EsIndexer(object):
         self.logger.info('Old paths deleted: %s' % self.format_count(old_document_count))
         self.logger.info('Indexing run done after %.2f minutes.' % (max(0, time.time() - start_time) / 60))
         self.logger.info('Elasticsearch import lasted %.2f minutes.' % (max(0, self.duration_elasticsearch) / 60))
+        self.log_crawl_governor_pauses()
+
+        self.elasticsearch_finish_rebuild()
+
+    def index_directories_sorted_merge(self) -> bool:
+        """
+        Imports the content of the directories into the elasticsearch index with a bounded amount of memory
+
+        The crawled paths are sorted (spilled to disk if necessary) and merge-joined against all documents of the
+        index, read in the same order via a point in time. Paths only found by the crawler are indexed, documents
+        whose path wasn't crawled are deleted. No document IDs are held in RAM.
+        Returns False if the indexing run was aborted.
+        """
+
+        paths_total = 0
+        documents = []
+        documents_indexed = 0
+        document_ids_old = []
+        documents_deleted = 0
+        self.duration_elasticsearch = 0
+        self.duration_crawl_paused = 0
+        self.crawl_watched_changes = 0
+        start_time = round(time.time())
+
+        self.logger.info('Starting to index the files and directories (sorted merge) ...')
+
+        # The point in time of the merge is opened after the crawl: changes handled by the watcher during the crawl
+        # would be undone by the merge (e. g. a path created after its directory was listed would be deleted)
+        visited_directories = {}
+        crawled_paths = self.sorter.sort(
+            full_path
+            for directory in self.directories
+            for full_path, name in self.crawl_directory(
+                directory,
+                visited_directories=visited_directories,
+                throttle=True,
+                watch_changes=False
+            )
+        )
+        indexed_documents = self.elasticsearch_scroll_sorted_paths()
+
+        try:
+            crawled_path = next(crawled_paths, None)
+            indexed_path, indexed_id = next(indexed_documents, (None, None))
+
+            while crawled_path is not None or indexed_path is not None:
+                if indexed_path is None or (crawled_path is not None and crawled_path < indexed_path):
+                    # Only found by the crawler: a new path
+                    document = self.elasticsearch_map_path_to_document(
+                        path=crawled_path,
+                        filename=os.path.basename(crawled_path)
+                    )
+
+                    if document is not None:
+                        paths_total += 1
+                        documents.append(document)
+                        if len(documents) >= self.elasticsearch_bulk_size:
+                            self.elasticsearch_bulk_action(documents)
+                            documents_indexed += len(documents)
+                            documents = []
+
+                            self.logger.info(
+                                '- %s paths indexed, elasticsearch import lasted %.2f / %.2f min(s)' % (
+                                    self.format_count(documents_indexed),
+                                    self.duration_elasticsearch / 60,
+                                    (time.time() - start_time) / 60
+                                )
+                            )
+
+                    crawled_path = next(crawled_paths, None)
+                elif crawled_path is None or indexed_path < crawled_path:
+                    # Only found in the index: the path was deleted
+                    document_ids_old.append(indexed_id)
+                    if len(document_ids_old) >= self.elasticsearch_bulk_size:
+                        self.elasticsearch_delete_documents(document_ids_old)
+                        documents_deleted += len(document_ids_old)
+                        document_ids_old = []
+
+                    indexed_path, indexed_id = next(indexed_documents, (None, None))
+                else:
+                    # Found in both: nothing to do
+                    paths_total += 1
+                    crawled_path = next(crawled_paths, None)
+                    indexed_path, indexed_id = next(indexed_documents, (None, None))
+        except Exception as err:
+            self.logger.error(
+                'Failed to merge the crawled paths with index "%s" at elasticsearch "%s", aborting this indexing run: %s' % (
+                    self.elasticsearch_index,
+                    self.elasticsearch_url,
+                    str(err)
+                )
+            )
+            return False
+        finally:
+            crawled_paths.close()
+            indexed_documents.close()
+
+        if len(documents) > 0:
+            self.elasticsearch_bulk_action(documents)
+            documents_indexed += len(documents)
+
+        if len(document_ids_old) > 0:
+            self.elasticsearch_delete_documents(document_ids_old)
+            documents_deleted += len(document_ids_old)
+
+        self.logger.info('Total paths crawled: %s' % self.format_count(paths_total))
+        self.logger.info('New paths indexed: %s' % self.format_count(documents_indexed))
+        self.logger.info('Old paths deleted: %s' % self.format_count(documents_deleted))
+        self.logger.info('Indexing run done after %.2f minutes.' % (max(0, time.time() - start_time) / 60))
+        self.logger.info('Elasticsearch import lasted %.2f minutes.' % (max(0, self.duration_elasticsearch) / 60))
+        self.log_crawl_governor_pauses()
+
+        return True
+
+    def index_subtree(self, directory: str, excluded_directories: list[str] = None,
+                      throttle: bool = True) -> typing.Union[tuple[int, int, int], None]:
+        """
+        Imports the content of one directory (without the excluded subdirectories) into the elasticsearch index
+
+        Only the documents below this directory are reconciled: their IDs are loaded from elasticsearch, new paths are
+        indexed and documents of paths that weren't found anymore are deleted.
+        Returns the amount of crawled, indexed and deleted paths or None if elasticsearch couldn't be queried.
+        """
+
+        directory = directory.rstrip('/')
+        if excluded_directories is None:
+            excluded_directories = []
+
+        document_ids_old = self.elasticsearch_get_ids_below(directory, excluded_directories)
+        if document_ids_old is None:
+            return None
+
+        paths_total = 0
+        documents = []
+        documents_indexed = 0
+        start_time = time.time()
+
+        self.logger.info('- Starting to index subtree "%s" ...' % directory)
+
+        for full_path, name in self.crawl_directory(directory, excluded_directories, throttle=throttle):
+            document = self.elasticsearch_map_path_to_document(
+                path=full_path,
+                filename=name
+            )
+
+            if document is None:
+                continue
+
+            paths_total += 1
+
+            if document['_id'] in document_ids_old:
+                del document_ids_old[document['_id']]
+                continue
+
+            if self.track_document_ids:
+                self.elasticsearch_document_ids[document['_id']] = 1
+
+            documents.append(document)
+            if len(documents) >= self.elasticsearch_bulk_size:
+                self.elasticsearch_bulk_action(documents)
+                documents_indexed += len(documents)
+                documents = []
+
+        if len(documents) > 0:
+            self.elasticsearch_bulk_action(documents)
+            documents_indexed += len(documents)
+
+        old_document_count = len(document_ids_old)
+        document_ids_old_list = list(document_ids_old.keys())
+        if self.track_document_ids:
+            for document_id in document_ids_old_list:
+                self.elasticsearch_document_ids.pop(document_id, None)
+
+        for start_index in range(0, old_document_count, self.elasticsearch_bulk_size):
+            self.elasticsearch_delete_documents(document_ids_old_list[start_index:start_index + self.elasticsearch_bulk_size])
+
+        self.logger.info(
+            '- Subtree "%s" done after %.2f min(s): %s paths crawled, %s new paths indexed, %s old paths deleted.' % (
+                directory,
+                (time.time() - start_time) / 60,
+                self.format_count(paths_total),
+                self.format_count(documents_indexed),
+                self.format_count(old_document_count)
+            )
+        )
+
+        return paths_total, documents_indexed, old_document_count
+
+    def index_path(self, path: str, use_spool: bool = False) -> bool:
+        """
+        Reconciles only the given path and everything below it, e. g. after restoring a directory from a backup
+
+        The rest of the index isn't touched. Returns False if the path isn't below the configured directories or
+        elasticsearch couldn't be queried. The daemon passes use_spool, so its operations stay in order.
+        """
+
+        path = path.rstrip('/')
+        if not self.path_should_be_indexed(path, True):
+            self.logger.error('"%s" is not below the configured directories or excluded.' % path)
+            return False
+
+        # A targeted repair fails fast instead of writing into the spool of a running daemon
+        spool = self.spool
+        if not use_spool:
+            self.spool = None
+        try:
+            self.duration_elasticsearch = 0
+            start_time = time.time()
+            self.logger.info('Starting to index the path "%s" ...' % path)
+
+            if path not in [directory.rstrip('/') for directory in self.directories]:
+                # The path itself is indexed too (the configured directories are not)
+                document = None
+                if os.path.lexists(path):
+                    document = self.elasticsearch_map_path_to_document(path=path, filename=os.path.basename(path))
+
+                if document is not None:
+                    self.elasticsearch_bulk_action([document])
+                else:
+                    self.elasticsearch_bulk_action([{'_op_type': 'delete', '_id': self.elasticsearch_map_path_to_id(path)}])
+
+            # A targeted repair isn't slowed down by the crawl governor
+            if self.index_subtree(path, throttle=False) is None:
+                return False
+
+            self.logger.info('Indexing of path "%s" done after %.2f minutes.' % (path, max(0, time.time() - start_time) / 60))
+            self.logger.info('Elasticsearch import lasted %.2f minutes.' % (max(0, self.duration_elasticsearch) / 60))
+        finally:
+            self.spool = spool
+
+        return True
+
+    def index_dirty_directories(self, dirty_directories: list[str]):
+        """ Imports only the subtrees the changes watcher saw changes in into the elasticsearch index """
+
+        self.duration_elasticsearch = 0
+        self.duration_crawl_paused = 0
+        self.crawl_watched_changes = 0
+        start_time = time.time()
+
+        dirty_directories = [directory for directory in dirty_directories if self.path_should_be_indexed(directory, True)]
+        self.logger.info('Starting to index %d dirty subtree(s) ...' % len(dirty_directories))
+
+        for directory in dirty_directories:
+            self.index_subtree(directory)
+
+        self.logger.info('Indexing run done after %.2f minutes.' % (max(0, time.time() - start_time) / 60))
+        self.logger.info('Elasticsearch import lasted %.2f minutes.' % (max(0, self.duration_elasticsearch) / 60))
+        self.log_crawl_governor_pauses()
+
+    def index_scheduled_directories(self):
+        """ Imports the directories (or subtrees) the scheduler deems necessary into the elasticsearch index """
+
+        self.duration_elasticsearch = 0
+        self.duration_crawl_paused = 0
+        self.crawl_watched_changes = 0
+        start_time = time.time()
+
+        self.logger.info('Starting to index the scheduled directories ...')
+
+        for unit in self.scheduler.due_units():
+            result = self.index_subtree(unit.path, self.scheduler.excluded_subtrees(unit))
+            if result is None:
+                # Elasticsearch couldn't be queried, try again during the next run
+                continue
+
+            paths_total, documents_indexed, documents_deleted = result
+            self.scheduler.record_crawl(unit, paths_total, documents_indexed + documents_deleted)
+
+        self.logger.info('Indexing run done after %.2f minutes.' % (max(0, time.time() - start_time) / 60))
+        self.logger.info('Elasticsearch import lasted %.2f minutes.' % (max(0, self.duration_elasticsearch) / 60))
+        self.log_crawl_governor_pauses()
+
+    def log_crawl_governor_pauses(self):
+        """ Logs how long the crawl governor paused the crawl during this indexing run """
+        if self.crawl_governor is not None:
+            self.logger.info(
+                'Crawl governor paused the crawl for %.2f minutes, %d filesystem changes handled meanwhile.' % (
+                    self.duration_crawl_paused / 60,
+                    self.crawl_watched_changes
+                )
+            )
+
+    def pause_crawl_for_governor(self, seconds: float):
+        """ Pauses the crawl for the crawl governor: the daemon's changes watcher handles the changes meanwhile """
+        if self.changes_watcher_active:
+            self.crawl_watched_changes += self.changes_watcher.watch(seconds, during_crawl=True)
+        else:
+            time.sleep(seconds)
+
+    def crawl_directory(self, directory: str, excluded_directories: list[str] = None,
+                        visited_directories: dict[tuple[int, int], str] = None,
+                        throttle: bool = False, watch_changes: bool = True) -> typing.Iterator[tuple[str, str]]:
+        """
+        Walks through the directory and yields the path and name of every file and dir that should be indexed
+
+        With a "crawl" config the device and inode of every directory is remembered in visited_directories (pass the
+        same dict to several calls to share it), so no directory is crawled twice, see crawl_should_descend().
+        With throttle the crawl is paced by the crawl governor (if configured). With watch_changes the changes
+        watcher of the daemon handles the filesystem changes while the crawl is paused, see pause_crawl_for_governor().
+        """
+
+        # The devices of the directories the crawler descended into (but didn't list yet)
+        directory_devices = {}
+        mount_points = None
+        if self.crawl_track_directories:
+            if visited_directories is None:
+                visited_directories = {}
+
+            try:
+                root_stat = os.lstat(directory)
+            except OSError as err:
+                self.logger.error('Failed to stat "%s": %s' % (directory, str(err)))
+                return
+
+            directory_devices[directory] = root_stat.st_dev
+            directory_key = (root_stat.st_dev, root_stat.st_ino)
+            visited_path = visited_directories.get(directory_key, None)
+            if visited_path is not None and (
+                visited_path == directory.rstrip('/')
+                or directory.startswith(visited_path + '/')
+                or self.crawl_duplicate_directories == 'skip'
+            ):
+                self.logger.info('- Skipping "%s": it was already crawled as "%s".' % (directory, visited_path))
+                return
+            visited_directories.setdefault(directory_key, directory.rstrip('/'))
+
+            if os.path.realpath(directory) == os.path.normpath(directory):
+                # Otherwise the paths below the directory can't be compared with the mount points
+                mount_points = self.crawl_mount_points()
+
+        # Depth first and top down like os.walk(), but with the DirEntry objects of os.scandir()
+        directories = [directory]
+        while len(directories) > 0:
+            root = directories.pop()
+
+            # The latency of the listing is the contention signal of the governor
+            listing_start = time.time()
+            files = []
+            dirs = []
+            try:
+                with os.scandir(root) as entries:
+                    for entry in entries:
+                        try:
+                            is_dir = entry.is_dir()
+                        except OSError:
+                            is_dir = False
+
+                        if is_dir:
+                            dirs.append(entry)
+                        else:
+                            files.append(entry)
+            except OSError:
+                # Like os.walk(): unreadable or meanwhile deleted directories are skipped
+                directory_devices.pop(root, None)
+                continue
+
+            if throttle and self.crawl_governor is not None:
+                # Every path is stat()ed to get its dates
+                stats = 2 * (len(files) + len(dirs)) if self.index_file_dates else 0
+                self.duration_crawl_paused += self.crawl_governor.throttle(
+                    time.time() - listing_start,
+                    stats,
+                    self.pause_crawl_for_governor if watch_changes else time.sleep
+                )
+
+            if not self.crawl_resumed.is_set():
+                self.logger.info('Crawling is paused, waiting for it to be resumed ...')
+                while watch_changes and not self.crawl_resumed.is_set():
+                    # Keep handling the filesystem changes (and flushes of the spool) while paused
+                    if self.changes_watcher_active:
+                        self.crawl_watched_changes += self.changes_watcher.watch(1, during_crawl=True)
+                        self.process_control_commands(during_crawl=True)
+                    else:
+                        self.process_control_commands(timeout=1, during_crawl=True)
+                self.crawl_resumed.wait()
+
+            self.progress_paths_crawled += len(files) + len(dirs)
+            for entry in itertools.chain(files, dirs):
+                if self.path_should_be_indexed(entry.path, False):
+                    yield entry.path, entry.name
+
+            # Symlinks to directories are indexed, but not followed (like os.walk())
+            dirs = [entry for entry in dirs if not entry.is_symlink()]
+
+            if excluded_directories:
+                # The excluded directories themselves are indexed, but not their content
+                dirs = [entry for entry in dirs if entry.path not in excluded_directories]
+
+            if self.crawl_track_directories:
+                device = directory_devices.pop(root, None)
+                descend = []
+                for entry in dirs:
+                    subdirectory_device = self.crawl_should_descend(entry, device, visited_directories, mount_points)
+                    if subdirectory_device is not None:
+                        directory_devices[entry.path] = subdirectory_device
+                        descend.append(entry)
+                dirs = descend
+
+            directories.extend(entry.path for entry in reversed(dirs))
+
+    def crawl_should_descend(self, entry: os.DirEntry, parent_device: int,
+                             visited_directories: dict[tuple[int, int], str],
+                             mount_points: typing.Union[set[str], None]) -> typing.Union[int, None]:
+        """
+        Decides whether the crawler descends into the directory (the directory itself is always indexed)
+
+        Returns the device of the directory or None if the crawler shouldn't descend into it.
+
+        A directory on another device (a mount point) is skipped with "crawl:one_file_system". A directory which was
+        already crawled (same device and inode) is skipped if it's the same path (overlapping directories) or one of
+        its parents (a loop via a bind mount). Other paths of the same directory (e. g. bind mounts) are crawled again
+        with "crawl:duplicate_directories" = "index" and skipped with "skip".
+
+        The inode is known from the listing. Only mount points (or every directory if the mount points are unknown)
+        are stat()ed: their device differs from the parent's and the listing contains the inode they cover.
+        """
+
+        path = entry.path
+        if mount_points is None or path in mount_points:
+            try:
+                stat = entry.stat(follow_symlinks=False)
+            except OSError:
+                # Deleted in the meantime, os.walk() would skip it anyway
+                return None
+            device, inode = stat.st_dev, stat.st_ino
+        else:
+            device, inode = parent_device, entry.inode()
+
+        if device != parent_device:
+            if self.crawl_one_file_system:
+                self.logger.debug('- Not descending into "%s": it is a mount point.' % path)
+                return None
+            self.logger.debug('- Descending into the mount point "%s".' % path)
+
+        directory_key = (device, inode)
+        visited_path = visited_directories.get(directory_key, None)
+        if visited_path is None:
+            visited_directories[directory_key] = path
+            return device
+
+        if visited_path == path or path.startswith(visited_path + '/') or self.crawl_duplicate_directories == 'skip':
+            self.logger.debug('- Not descending into "%s": it was already crawled as "%s".' % (path, visited_path))
+            return None
+
+        return device
+
+    @staticmethod
+    def crawl_mount_points() -> typing.Union[set[str], None]:
+        """ Returns the paths of all mount points (see /proc/self/mountinfo) or None if they are unknown """
+        try:
+            with open('/proc/self/mountinfo', 'r', errors='surrogateescape') as f:
+                # The 5th field is the mount point, with spaces, tabs, newlines and backslashes escaped as octal
+                return set(
+                    re.sub(r'\\([0-7]{3})', lambda re_match: chr(int(re_match.group(1), 8)), line.split(' ')[4])
+                    for line in f
+                )
+        except (OSError, IndexError):
+            return None
+
+    def elasticsearch_delete_documents(self, document_ids: list[str]):
+        """ Deletes the documents with the given IDs from elasticsearch """
+
+        if self.spool is not None and self.spool.has_pending():
+            # Keep the order of all operations: the spooled ones must be sent first
+            self.elasticsearch_bulk_action([{'_op_type': 'delete', '_id': document_id} for document_id in document_ids])
+            return
+
+        delete_start_time = time.time()
+        try:
+            self.elasticsearch.delete_by_query(
+                index=self.elasticsearch_index,
+                query={
+                    "terms": {
+                        "_id": document_ids
+                    }
+                }
+            )
+        except Exception as err:
+            if self.spool is None or not self.elasticsearch_is_unavailable(err):
+                raise
+
+            self.elasticsearch_bulk_action([{'_op_type': 'delete', '_id': document_id} for document_id in document_ids])
+            return
+
+        self.duration_elasticsearch += time.time() - delete_start_time
 
     def path_should_be_indexed(self, path: str, test_parent_directory: bool):
         """ Tests if a specific path (dir or file) should be indexed """
@@ -394,7 +1278,8 @@ class Fs2EsIndexer(object):
             parent_dir_is_included = False
 
             for directory in self.directories:
-                if path.startswith(directory):
+                # "/srv/share" must not include "/srv/share2"
+                if path == directory or path.startswith(directory.rstrip('/') + '/'):
                     parent_dir_is_included = True
                     break
 
@@ -438,6 +1323,13 @@ class Fs2EsIndexer(object):
 
     def delete_index(self):
         """ Deletes the index """
+        if self.elasticsearch_use_alias and self.elasticsearch.indices.exists_alias(name=self.elasticsearch_index):
+            # Elasticsearch can't delete an index via its alias
+            for index in self.elasticsearch_indices_behind_alias():
+                self.logger.info('Deleting index "%s" behind alias "%s"...' % (index, self.elasticsearch_index))
+                self.elasticsearch.indices.delete(index=index)
+            return
+
         self.logger.info('Deleting index "%s"...' % self.elasticsearch_index)
         self.elasticsearch.indices.delete(index=self.elasticsearch_index)
 
@@ -445,23 +1337,196 @@ class Fs2EsIndexer(object):
         """ Starts the daemon mode of the indexer"""
         self.logger.info('Starting indexing in daemon mode with a wait time of %s between indexing runs.' % self.daemon_wait_time)
 
-        changes_watcher_active = self.changes_watcher.start()
+        if self.spool_locked:
+            # The daemon must not lose changes: let SystemD restart it until the other process is done
+            self.logger.error('The daemon needs the spool, but another process holds its lock.')
+            exit(1)
+
+        self.changes_watcher_active = self.changes_watcher.start()
 
         self.elasticsearch_prepare_index()
 
-        # Get all document IDs from ES and add new paths to it
-        self.elasticsearch_get_all_ids()
-        self.index_directories()
+        # Send all operations spooled during the last run
+        self.set_phase('replaying_spool')
+        self.elasticsearch_replay_spool()
 
+        if self.scheduler is None or self.elasticsearch_rebuild_pending():
+            # Get all document IDs from ES and add new paths to it
+            if self.reconciliation_mode == 'memory':
+                self.set_phase('loading_ids')
+                self.elasticsearch_get_all_ids()
+            self.run_indexing('full', self.index_directories)
+        else:
+            # Every directory is due during the first run
+            self.run_indexing('scheduled', self.index_scheduled_directories)
+
+        indexing_runs = 0
         while True:
-            if changes_watcher_active:
+            if self.changes_watcher_active:
+                self.set_phase('watching')
                 changes = self.changes_watcher.watch(self.daemon_wait_seconds)
                 self.logger.info('%d filesystem changes in this waiting period handled.' % changes)
             else:
+                self.set_phase('sleeping')
                 self.logger.info('No changes-watcher is active, starting next indexing run in %s.' % self.daemon_wait_time)
-                time.sleep(self.daemon_wait_seconds)
+                self.wait(self.daemon_wait_seconds)
+
+            if self.spool is not None:
+                self.set_phase('replaying_spool')
+                self.spool.sync()
+                if self.elasticsearch_replay_spool() and self.elasticsearch_rebuild_filled:
+                    # The swap of a filled index was postponed because of the spooled operations
+                    self.elasticsearch_finish_rebuild()
+
+            if not self.crawl_resumed.is_set():
+                # The dirty directories are kept for the first indexing run after resuming
+                self.logger.info('Crawling is paused via the control socket, skipping this indexing run.')
+                continue
+
+            indexing_runs += 1
+            dirty_directories = self.changes_watcher.pop_dirty_directories()
+
+            if self.scheduler is not None and not self.elasticsearch_rebuild_pending():
+                self.run_indexing('scheduled', self.index_scheduled_directories)
+            elif (
+                self.dirty_subtrees_enabled
+                and self.changes_watcher_active
+                and not self.elasticsearch_rebuild_pending()
+                and dirty_directories is not None
+                and (self.dirty_subtrees_full_index_every == 0 or indexing_runs % self.dirty_subtrees_full_index_every != 0)
+            ):
+                self.run_indexing('dirty_subtrees', self.index_dirty_directories, dirty_directories)
+            else:
+                self.run_indexing('full', self.index_directories)
+
+    def run_indexing(self, kind: str, index_function: typing.Callable, *args):
+        """ Runs an indexing run of the daemon and remembers its summary for the control socket """
+        self.set_phase('indexing')
+        self.progress_paths_crawled = 0
+        start_time = time.time()
+
+        index_function(*args)
+
+        self.last_indexing_run = {
+            'kind': kind,
+            'finished_at': datetime.datetime.now().isoformat(timespec='seconds'),
+            'seconds': round(time.time() - start_time, 1),
+            'paths_crawled': self.progress_paths_crawled,
+        }
+
+    def set_phase(self, phase: str) -> str:
+        """ Switches the daemon into the phase, accounts the time spent in the previous one and returns its name """
+        with self.status_lock:
+            now = time.time()
+            stats = self.phase_stats.setdefault(self.phase, {'count': 0, 'seconds': 0})
+            stats['count'] += 1
+            stats['seconds'] += now - self.phase_started
+
+            previous_phase = self.phase
+            self.phase = phase
+            self.phase_started = now
+
+        return previous_phase
+
+    def wait(self, seconds: float):
+        """ Waits like time.sleep(), but executes the commands of the control socket in the meantime """
+        stop_at = time.time() + seconds
+        while time.time() < stop_at:
+            self.process_control_commands(stop_at - time.time())
+
+    def control_status(self) -> dict[str, typing.Any]:
+        """ Returns the current state and progress of the daemon """
+        with self.status_lock:
+            phase = self.phase
+            phase_seconds = time.time() - self.phase_started
+
+        return {
+            'index': self.elasticsearch_index,
+            'phase': phase,
+            'phase_seconds': round(phase_seconds, 1),
+            'paths_crawled': self.progress_paths_crawled,
+            'crawl_paused': not self.crawl_resumed.is_set(),
+            'spooled_operations': self.spool.records_pending if self.spool is not None else 0,
+            'dirty_directories': None if self.changes_watcher.dirty_directories_overflow else len(self.changes_watcher.dirty_directories),
+            'queued_commands': self.control_commands.qsize(),
+            'last_indexing_run': self.last_indexing_run,
+        }
+
+    def control_stats(self) -> dict[str, typing.Any]:
+        """ Returns how often and how long the daemon was in each phase (including the current one) """
+        with self.status_lock:
+            stats = {phase: dict(phase_stats) for phase, phase_stats in self.phase_stats.items()}
+            current = stats.setdefault(self.phase, {'count': 0, 'seconds': 0})
+            current['count'] += 1
+            current['seconds'] += time.time() - self.phase_started
+
+        for phase_stats in stats.values():
+            phase_stats['seconds'] = round(phase_stats['seconds'], 1)
+
+        return {'index': self.elasticsearch_index, 'phases': stats}
+
+    def pause_crawl(self):
+        """ Pauses the crawler: a running crawl waits, the daemon skips indexing runs until resume_crawl() """
+        self.crawl_resumed.clear()
+        self.logger.info('Crawling paused via the control socket.')
+
+    def resume_crawl(self):
+        """ Resumes the crawler """
+        self.crawl_resumed.set()
+        self.logger.info('Crawling resumed via the control socket.')
+
+    def enqueue_control_command(self, command: str, args: dict[str, typing.Any]):
+        """ Queues a command for the daemon, it is executed as soon as the current work step is done """
+        self.control_commands.put((command, args))
+
+    def process_control_commands(self, timeout: float = 0, during_crawl: bool = False):
+        """
+        Executes all queued commands, waits up to timeout seconds for the first one
+
+        during_crawl: called while a crawl is paused, so nothing is crawled (a flush only replays the spool).
+        """
+        try:
+            if timeout > 0:
+                command, args = self.control_commands.get(timeout=timeout)
+            else:
+                command, args = self.control_commands.get_nowait()
+        except queue.Empty:
+            return
+
+        while True:
+            previous_phase = self.set_phase(command)
+            try:
+                if command == 'reindex' and (during_crawl or not self.crawl_resumed.is_set()):
+                    # Paused after the command was queued: its crawl would block the daemon until "resume"
+                    self.logger.info('Crawling is paused via the control socket, dropping the reindex of "%s".' % args['path'])
+                elif command == 'reindex':
+                    self.index_path(args['path'], use_spool=True)
+                elif command == 'flush':
+                    self.flush_pending_changes(crawl_dirty_directories=not during_crawl)
+            except Exception as err:
+                self.logger.error('Command "%s" of the control socket failed: %s' % (command, repr(err)))
+            finally:
+                self.set_phase(previous_phase)
 
-            self.index_directories()
+            try:
+                command, args = self.control_commands.get_nowait()
+            except queue.Empty:
+                return
+
+    def flush_pending_changes(self, crawl_dirty_directories: bool = True):
+        """ Sends the spooled operations now and reconciles the dirty directories instead of waiting for the next run """
+        if self.spool is not None:
+            self.spool.sync()
+            self.elasticsearch_replay_spool()
+
+        if self.dirty_subtrees_enabled and crawl_dirty_directories and self.crawl_resumed.is_set():
+            # While paused, the dirty directories are kept for the first indexing run after resuming
+            dirty_directories = self.changes_watcher.pop_dirty_directories()
+            if dirty_directories is None:
+                # Too many, leave them to the next (full) indexing run
+                self.changes_watcher.dirty_directories_overflow = True
+            elif len(dirty_directories) > 0:
+                self.index_dirty_directories(dirty_directories)
 
     def search(self, search_path: str, search_term=None, search_filename=None, verbose: bool = False):
         """
@@ -525,19 +1590,11 @@ class Fs2EsIndexer(object):
         """ Reads all document IDs from elasticsearch """
         self.logger.info('Loading all document IDs from elasticsearch...')
 
-        resp = None
         start_time = time.time()
 
         try:
-            resp = self.elasticsearch.search(
-                index=self.elasticsearch_index,
-                query={
-                    "match_all": {}
-                },
-                stored_fields=[],
-                size=self.elasticsearch_bulk_size,
-                scroll='1m'
-            )
+            for document_id in self.elasticsearch_scroll_ids({"match_all": {}}):
+                self.elasticsearch_document_ids[document_id] = 1
         except elasticsearch.exceptions.ConnectionError as err:
             self.logger.error('Failed to connect to elasticsearch at "%s": %s' % (self.elasticsearch_url, str(err)))
             return
@@ -551,9 +1608,89 @@ class Fs2EsIndexer(object):
             )
             return
 
+        self.logger.info(
+            'Loaded %s ID(s) from elasticsearch in %.2f min' % (
+                self.format_count(len(self.elasticsearch_document_ids)),
+                (time.time() - start_time) / 60
+            )
+        )
+
+    def elasticsearch_get_ids_below(self, directory: str, excluded_directories: list[str]) -> typing.Union[dict, None]:
+        """ Reads the IDs of all documents below the directory (but not below the excluded ones) from elasticsearch """
+
+        query = {
+            "bool": {
+                "filter": [
+                    {"prefix": {"path.real": directory.rstrip('/') + '/'}}
+                ],
+                "must_not": [
+                    {"prefix": {"path.real": excluded_directory.rstrip('/') + '/'}}
+                    for excluded_directory in excluded_directories
+                ]
+            }
+        }
+
+        document_ids = {}
+        try:
+            for document_id in self.elasticsearch_scroll_ids(query):
+                document_ids[document_id] = 1
+        except Exception as err:
+            self.logger.error(
+                'Failed to load the document IDs below "%s" from index "%s" at elasticsearch "%s": %s' % (
+                    directory,
+                    self.elasticsearch_index,
+                    self.elasticsearch_url,
+                    str(err)
+                )
+            )
+            return None
+
+        return document_ids
+
+    def elasticsearch_scroll_sorted_paths(self) -> typing.Iterator[tuple[str, str]]:
+        """ Yields the path and ID of all documents sorted by path via a point in time """
+
+        pit = self.elasticsearch.open_point_in_time(index=self.elasticsearch_index, keep_alive='5m')
+        try:
+            search_after = None
+            while True:
+                resp = self.elasticsearch.search(
+                    pit={'id': pit['id'], 'keep_alive': '5m'},
+                    query={"match_all": {}},
+                    sort=[{"path.real": "asc"}],
+                    search_after=search_after,
+                    source=False,
+                    size=self.elasticsearch_bulk_size
+                )
+
+                if len(resp['hits']['hits']) == 0:
+                    break
+
+                for document in resp['hits']['hits']:
+                    yield document['sort'][0], document['_id']
+
+                pit['id'] = resp.get('pit_id', pit['id'])
+                search_after = resp['hits']['hits'][-1]['sort']
+        finally:
+            try:
+                self.elasticsearch.close_point_in_time(id=pit['id'])
+            except Exception as err:
+                self.logger.debug('Failed to close the point in time: %s' % str(err))
+
+    def elasticsearch_scroll_ids(self, query: dict) -> typing.Iterator[str]:
+        """ Yields the IDs of all documents matching the query """
+
+        resp = self.elasticsearch.search(
+            index=self.elasticsearch_index,
+            query=query,
+            stored_fields=[],
+            size=self.elasticsearch_bulk_size,
+            scroll='1m'
+        )
+
         while len(resp['hits']['hits']) > 0:
             for document in resp['hits']['hits']:
-                self.elasticsearch_document_ids[document['_id']] = 1
+                yield document['_id']
 
             self.logger.debug('- Calling es.scroll() with ID "%s"' % resp['_scroll_id'])
 
@@ -562,13 +1699,6 @@ class Fs2EsIndexer(object):
                 scroll='1m'
             )
 
-        self.logger.info(
-            'Loaded %s ID(s) from elasticsearch in %.2f min' % (
-                self.format_count(len(self.elasticsearch_document_ids)),
-                (time.time() - start_time) / 60
-            )
-        )
-
     def enable_slowlog(self):
         """ Enables the slow log """
         self.logger.info('Setting the slowlog thresholds on index %s to "0"...' % self.elasticsearch_index)
@@ -652,7 +1782,16 @@ class Fs2EsIndexer(object):
 
         self.logger.debug('*- Import ES doc for "%s"' % path)
 
-        self.elasticsearch_document_ids[document['_id']] = 1
+        if self.scheduler is not None:
+            self.scheduler.record_change(path)
+
+        if self.track_document_ids:
+            self.elasticsearch_document_ids[document['_id']] = 1
+
+        if self.spool is not None:
+            # Goes to the spool if elasticsearch is unavailable
+            self.elasticsearch_bulk_action([document])
+            return 1
 
         self.elasticsearch.index(
             index=self.elasticsearch_index,
@@ -672,13 +1811,22 @@ class Fs2EsIndexer(object):
 
         self.logger.debug('*- Delete ES doc for "%s"' % path)
 
+        if self.scheduler is not None:
+            self.scheduler.record_change(path)
+
         document_id_old = self.elasticsearch_map_path_to_id(path)
 
-        try:
-            del self.elasticsearch_document_ids[document_id_old]
-        except:
-            # If the key was already deleted - thats ok!
-            pass
+        if self.track_document_ids:
+            try:
+                del self.elasticsearch_document_ids[document_id_old]
+            except:
+                # If the key was already deleted - thats ok!
+                pass
+
+        if self.spool is not None:
+            # Goes to the spool if elasticsearch is unavailable
+            self.elasticsearch_bulk_action([{'_op_type': 'delete', '_id': document_id_old}])
+            return 1
 
         try:
             self.elasticsearch.delete(
@@ -695,6 +1843,12 @@ class Fs2EsIndexer(object):
         # If source_path WAS a directory, we have to move all files and subdirectories BELOW it too.
         changes = 0
         resp = self.search(source_path)
+        if resp is None:
+            # Elasticsearch is unavailable: move at least the path itself, the next indexing run will fix the rest
+            changes += self.delete_path(source_path)
+            changes += self.import_path(target_path)
+            return changes
+
         for hit in resp['hits']['hits']:
             # Each of these documents got moved from source_path to target_path!
 
@@ -0,0 +1,163 @@
+#-*- coding: utf-8 -*-
+
+import copy
+import os
+import threading
+import typing
+
+from lib.ControlSocket import *
+from lib.Fs2EsIndexer import *
+
+
+class Fs2EsIndexerPool(object):
+    """
+    Creates one indexer per configured share and runs them concurrently
+
+    Each share has its own elasticsearch index, its own document IDs, its own bulk pipeline and its own schedule.
+    Without a "shares" config there is just one indexer for all directories.
+    """
+
+    def __init__(self, config: dict[str, typing.Any], logger):
+        self.logger = logger
+        self.indexers = []
+        self.control_socket_path = config.get('control_socket', None)
+
+        shares = config.get('shares', None)
+        if shares is None:
+            self.indexers.append(Fs2EsIndexer(config, logger))
+            return
+
+        global_config = dict(config)
+        del global_config['shares']
+
+        indices = []
+        for share in shares:
+            share_config = self.merge_config(global_config, share)
+            share_index = share_config.get('elasticsearch', {}).get('index', 'files')
+
+            if share_index in indices:
+                self.logger.error('Every share needs its own "elasticsearch:index", "%s" is used more than once.' % share_index)
+                exit(1)
+            indices.append(share_index)
+
+            if 'spool' in share_config and 'path' not in share.get('spool', {}):
+                # The shares must not write into the same spool file
+                spool_path, spool_extension = os.path.splitext(share_config['spool'].get('path', '/var/lib/fs2es-indexer/spool.jsonl'))
+                share_config['spool']['path'] = '%s-%s%s' % (spool_path, share_index, spool_extension)
+
+            self.indexers.append(Fs2EsIndexer(share_config, logger.getChild(share_index)))
+
+        governor_config = global_config.get('crawl_governor', None)
+        if governor_config is not None:
+            # The global limits apply to all shares together (they crawl the same disks), a share with its own
+            # "crawl_governor" keeps its own governor
+            crawl_governor = CrawlGovernor(governor_config, logger)
+            for share, indexer in zip(shares, self.indexers):
+                if 'crawl_governor' not in share:
+                    indexer.crawl_governor = crawl_governor
+
+    @staticmethod
+    def merge_config(base: dict[str, typing.Any], override: dict[str, typing.Any]) -> dict[str, typing.Any]:
+        """ Returns a copy of base with all values of override, nested dicts are merged too """
+        merged = copy.deepcopy(base)
+        for key, value in override.items():
+            if type(value) is dict and type(merged.get(key, None)) is dict:
+                merged[key] = Fs2EsIndexerPool.merge_config(merged[key], value)
+            else:
+                merged[key] = copy.deepcopy(value)
+
+        return merged
+
+    def indexer_for_path(self, path: str) -> Fs2EsIndexer:
+        """ Returns the indexer of the share which contains the path (or the first one) """
+        for indexer in self.indexers:
+            for directory in indexer.directories:
+                # "/srv/share" must not include "/srv/share2"
+                if path == directory or path.startswith(directory.rstrip('/') + '/'):
+                    return indexer
+
+        return self.indexers[0]
+
+    def run(self, action: typing.Callable[[Fs2EsIndexer], typing.Any]):
+        """
+        Runs the action for every indexer concurrently and waits until all are done
+
+        If the action fails for any indexer, the whole process exits, so it can be restarted (e. g. by SystemD).
+        """
+
+        if len(self.indexers) == 1:
+            action(self.indexers[0])
+            return
+
+        failed = threading.Event()
+
+        def run_indexer(indexer: Fs2EsIndexer):
+            try:
+                action(indexer)
+            except BaseException as err:
+                indexer.logger.error('Indexing pipeline of index "%s" failed: %s' % (indexer.elasticsearch_index, repr(err)))
+                failed.set()
+
+        threads = []
+        for indexer in self.indexers:
+            thread = threading.Thread(
+                target=run_indexer,
+                args=(indexer,),
+                name='fs2es-indexer-%s' % indexer.elasticsearch_index,
+                daemon=True
+            )
+            thread.start()
+            threads.append(thread)
+
+        while any(thread.is_alive() for thread in threads):
+            if failed.wait(1):
+                break
+
+        if failed.is_set():
+            self.logger.error('At least one indexing pipeline failed, stopping all pipelines.')
+            exit(1)
+
+    def start_control_socket(self):
+        """ Listens for commands to the daemon on the control socket (if configured) """
+        if self.control_socket_path is not None:
+            ControlSocketServer(self.control_socket_path, self.control, self.logger).start()
+
+    def control(self, request: dict[str, typing.Any]) -> dict[str, typing.Any]:
+        """
+        Handles a request of the control socket
+
+        "status" and "stats" are answered right away, "pause" and "resume" take effect immediately. "reindex" and
+        "flush" are queued and executed by the daemon as soon as its current work step is done.
+        """
+
+        command = request['command']
+        if command == 'status':
+            return {'ok': True, 'indices': [indexer.control_status() for indexer in self.indexers]}
+        elif command == 'stats':
+            return {'ok': True, 'indices': [indexer.control_stats() for indexer in self.indexers]}
+        elif command == 'pause':
+            for indexer in self.indexers:
+                indexer.pause_crawl()
+            return {'ok': True}
+        elif command == 'resume':
+            for indexer in self.indexers:
+                indexer.resume_crawl()
+            return {'ok': True}
+        elif command == 'reindex':
+            path = request.get('path', None)
+            if not path:
+                return {'ok': False, 'error': '"reindex" needs a "path".'}
+
+            indexer = self.indexer_for_path(path)
+            if not indexer.crawl_resumed.is_set():
+                # The crawl of the path would wait for "resume" and block the daemon meanwhile
+                return {'ok': False, 'error': 'Crawling is paused, "resume" it before a "reindex".'}
+
+            indexer.enqueue_control_command('reindex', {'path': path})
+            return {'ok': True, 'queued': True, 'index': indexer.elasticsearch_index}
+        elif command == 'flush':
+            for indexer in self.indexers:
+                indexer.enqueue_control_command('flush', {})
+            return {'ok': True, 'queued': True}
+
+        return {'ok': False, 'error': 'Unknown command "%s", allowed are "status", "stats", "pause", "resume", "reindex" and "flush".' % command}
@@ -0,0 +1,151 @@
+#-*- coding: utf-8 -*-
+
+import elasticsearch
+import elasticsearch.helpers
+import json
+import time
+
+from lib.SearchBenchmark import *
+
+
+class MappingProfileComparison(object):
+    """
+    Compares the mapping profiles ("default" and "substring") on a sample of the crawled paths
+
+    Each profile gets its own temporary index, which is filled with the same documents. The report contains the
+    indexing throughput, the size of the index and the hits and latency of the spotlight queries per profile: a
+    faster profile is only better if it finds the same files.
+    """
+
+    PROFILES = ('default', 'substring')
+
+    def __init__(self, indexer, sample_size: int, query_count: int, concurrency: int):
+        self.indexer = indexer
+        self.logger = indexer.logger
+        self.sample_size = sample_size
+        self.query_count = query_count
+        self.concurrency = concurrency
+
+    def sample_documents(self) -> list[dict]:
+        """ Crawls the directories until sample_size documents are found """
+
+        documents = []
+        for directory in self.indexer.directories:
+            for full_path, name in self.indexer.crawl_directory(directory):
+                document = self.indexer.elasticsearch_map_path_to_document(path=full_path, filename=name)
+                if document is None:
+                    continue
+
+                documents.append(document)
+                if len(documents) >= self.sample_size:
+                    return documents
+
+        return documents
+
+    def run(self, search_path: str):
+        """ Fills a temporary index per profile, benchmarks it and logs the comparison """
+
+        self.logger.info('Crawling a sample of %d paths ...' % self.sample_size)
+        documents = self.sample_documents()
+        if len(documents) == 0:
+            self.logger.error('No paths found in the configured directories.')
+            return
+
+        # The same queries for every profile
+        queries = SearchBenchmark(self.indexer, self.concurrency).generate_queries_from_filenames(
+            [document['_source']['file']['filename'] for document in documents],
+            search_path,
+            self.query_count
+        )
+
+        results = []
+        for profile in self.PROFILES:
+            mapping_file = self.indexer.mapping_profile_file(self.indexer.elasticsearch_index_mapping_file, profile)
+            with open(mapping_file, 'r') as f:
+                mapping = json.load(f)
+
+            settings_file = self.indexer.mapping_profile_file(self.indexer.elasticsearch_index_settings_file, profile)
+            with open(settings_file, 'r') as f:
+                settings = json.load(f)
+
+            index = '%s-profile-%s' % (self.indexer.elasticsearch_index, profile)
+            results.append(self.run_profile(profile, index, mapping, settings, documents, queries))
+
+        self.logger.info('Comparison of the mapping profiles with %d documents:' % len(documents))
+        self.logger.info(
+            '%-10s %12s %12s %-26s %10s %10s %10s %10s' % ('profile', 'docs/s', 'size (MB)', 'shape', 'hits', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)')
+        )
+        for profile, documents_per_second, size, report in results:
+            for shape, queries, errors, hits, p50, p95, p99, queries_per_second in report:
+                self.logger.info(
+                    '%-10s %12.0f %12.1f %-26s %10d %10.1f %10.1f %10.1f' % (
+                        profile,
+                        documents_per_second,
+                        size / 1024 / 1024,
+                        shape,
+                        hits,
+                        p50,
+                        p95,
+                        p99
+                    )
+                )
+
+        # The same queries must find the same files, otherwise the latencies aren't comparable
+        hits_by_shape = {}
+        for profile, documents_per_second, size, report in results:
+            for shape, queries, errors, hits, p50, p95, p99, queries_per_second in report:
+                hits_by_shape.setdefault(shape, {})[profile] = hits
+        for shape, hits_by_profile in hits_by_shape.items():
+            if len(set(hits_by_profile.values())) > 1:
+                self.logger.info(
+                    'The profiles find different amounts of files with the "%s" queries: %s' % (
+                        shape,
+                        ', '.join('%s: %d' % (profile, hits) for profile, hits in hits_by_profile.items())
+                    )
+                )
+
+    def run_profile(self, profile: str, index: str, mapping: dict, settings: dict, documents: list[dict],
+                    queries: dict[str, list[str]]):
+        """ Creates the temporary index of the profile, fills and benchmarks it and deletes it again """
+
+        if self.indexer.elasticsearch.indices.exists(index=index):
+            self.indexer.elasticsearch.indices.delete(index=index)
+
+        self.logger.info('Creating temporary index "%s" with mapping profile "%s" ...' % (index, profile))
+        self.indexer.elasticsearch.indices.create(
+            index=index,
+            mappings=mapping['mappings'],
+            settings=settings
+        )
+
+        try:
+            start_time = time.time()
+            for start_index in range(0, len(documents), self.indexer.elasticsearch_bulk_size):
+                elasticsearch.helpers.bulk(
+                    self.indexer.elasticsearch,
+                    documents[start_index:start_index + self.indexer.elasticsearch_bulk_size],
+                    index=index
+                )
+            self.indexer.elasticsearch.indices.refresh(index=index)
+            documents_per_second = len(documents) / max(time.time() - start_time, 0.001)
+
+            # Merge the segments, so the sizes of the profiles are comparable
+            self.indexer.elasticsearch.options(request_timeout=3600).indices.forcemerge(index=index, max_num_segments=1)
+            stats = self.indexer.elasticsearch.indices.stats(index=index, metric='store')
+            size = stats['_all']['primaries']['store']['size_in_bytes']
+
+            self.logger.info(
+                'Indexed %d documents into "%s" with %.0f docs/s, the index has %.1f MB.' % (
+                    len(documents),
+                    index,
+                    documents_per_second,
+                    size / 1024 / 1024
+                )
+            )
+
+            report = SearchBenchmark(self.indexer, self.concurrency, index).run(queries)
+        finally:
+            self.logger.info('Deleting temporary index "%s" ...' % index)
+            self.indexer.elasticsearch.indices.delete(index=index)
+
+        return profile, documents_per_second, size, report
@@ -0,0 +1,199 @@
+#-*- coding: utf-8 -*-
+
+import concurrent.futures
+import json
+import math
+import random
+import re
+import time
+import typing
+
+
+class SearchBenchmark(object):
+    """
+    Replays spotlight queries the way Samba sends them and reports the latency and throughput per query shape
+
+    The queries are either generated from the indexed filenames or extracted from an elasticsearch slowlog
+    (see Fs2EsIndexer.enable_slowlog()).
+    """
+
+    # The query_string shapes Samba generates, see Fs2EsIndexer.search()
+    QUERY_SHAPES = {
+        # A search on all attributes with "elasticsearch:force substring search = yes"
+        'all_attributes_substring': '(*%(term)s* OR content:*%(term)s*) AND path.real.fulltext:"%(path)s"',
+        # A search on all attributes without substring search
+        'all_attributes_prefix': '(%(term)s* OR content:%(term)s*) AND path.real.fulltext:"%(path)s"',
+        # A search on the file or directory name (kMDItemFSName) with substring search
+        'filename_substring': '(file.filename:*%(term)s*) AND path.real.fulltext:"%(path)s"',
+        # A search on the file or directory name (kMDItemFSName) without substring search
+        'filename_prefix': '(file.filename:%(term)s*) AND path.real.fulltext:"%(path)s"',
+    }
+
+    def __init__(self, indexer, concurrency: int, index: str = None):
+        self.indexer = indexer
+        self.logger = indexer.logger
+        self.concurrency = concurrency
+        self.index = index if index is not None else indexer.elasticsearch_index
+
+    def generate_queries(self, search_path: str, count: int) -> dict[str, list[str]]:
+        """ Samples filenames from the index and builds count queries of every shape from their words """
+
+        resp = self.indexer.elasticsearch.search(
+            index=self.index,
+            query={
+                "function_score": {
+                    "query": {"prefix": {"path.real": search_path.rstrip('/') + '/'}},
+                    "random_score": {}
+                }
+            },
+            source_includes=['file.filename'],
+            size=count
+        )
+
+        filenames = [hit['_source']['file']['filename'] for hit in resp['hits']['hits']]
+
+        return self.generate_queries_from_filenames(filenames, search_path, count)
+
+    def generate_queries_from_filenames(self, filenames: list[str], search_path: str, count: int) -> dict[str, list[str]]:
+        """ Builds count queries of every shape from the words of the filenames """
+
+        terms = []
+        for filename in filenames:
+            # The same word boundaries as the tokenizer in es-index-settings.json
+            words = re.findall(r'[a-zA-Z0-9]+', filename)
+            if len(words) > 0:
+                # Users type their search terms in lower case, whatever the case of the file names
+                terms.append(random.choice(words).lower())
+
+        if len(terms) == 0:
+            self.logger.error('No filenames found below "%s" to generate queries from.' % search_path)
+            return {}
+
+        self.logger.info('Generated %d search term(s) from the filenames below "%s".' % (len(terms), search_path))
+
+        queries = {}
+        for shape, query_format in self.QUERY_SHAPES.items():
+            queries[shape] = [
+                query_format % {'term': terms[i % len(terms)], 'path': search_path}
+                for i in range(count)
+            ]
+
+        return queries
+
+    def extract_queries(self, slowlog_file: str) -> dict[str, list[str]]:
+        """ Extracts the query_string queries from an elasticsearch slowlog and groups them by shape """
+
+        queries = {}
+        with open(slowlog_file, 'r', errors='replace') as f:
+            for line in f:
+                query = self.extract_query(line)
+                if query is None:
+                    continue
+
+                queries.setdefault(self.query_shape(query), []).append(query)
+
+        self.logger.info(
+            'Extracted %d query(s) from the slowlog "%s".' % (sum(len(shape_queries) for shape_queries in queries.values()), slowlog_file)
+        )
+
+        return queries
+
+    @staticmethod
+    def extract_query(line: str) -> typing.Union[str, None]:
+        """ Extracts the query_string query of a slowlog line, the source may be (double) JSON-escaped """
+
+        for unescapes in range(3):
+            re_match = re.search(r'"query_string"\s*:\s*\{\s*"query"\s*:\s*("(?:[^"\\]|\\.)*")', line)
+            if re_match:
+                try:
+                    return json.loads(re_match.group(1))
+                except ValueError:
+                    return None
+
+            # The source of the query is a JSON string in the JSON slowlog line: unescape it once more
+            line = line.replace('\\"', '"').replace('\\\\', '\\')
+
+        return None
+
+    def query_shape(self, query: str) -> str:
+        """ Maps a query to the name of its shape by replacing the search term and path """
+
+        shape_query = re.sub(r'path\.real\.fulltext\s*:\s*"(?:[^"\\]|\\.)*"', 'path.real.fulltext:"PATH"', query)
+        shape_query = re.sub(r'\*[^\s()*:]+\*', '*TERM*', shape_query)
+        shape_query = re.sub(r'(?<![\w*.])[^\s()*:"]+\*', 'TERM*', shape_query)
+
+        for shape, query_format in self.QUERY_SHAPES.items():
+            if re.sub(r'\s+', '', shape_query) == re.sub(r'\s+', '', query_format % {'term': 'TERM', 'path': 'PATH'}):
+                return shape
+
+        return 'other'
+
+    def run(self, queries: dict[str, list[str]]) -> list[tuple[str, int, int, int, float, float, float, float]]:
+        """
+        Runs the queries shape by shape with the configured concurrency and logs the report
+
+        Returns the report: shape, queries, errors, hits (of all queries), p50, p95 and p99 latency (in ms) and
+        queries per second
+        """
+
+        report = []
+        for shape, shape_queries in queries.items():
+            if len(shape_queries) == 0:
+                continue
+
+            self.logger.info(
+                'Running %d "%s" query(s) with a concurrency of %d ...' % (len(shape_queries), shape, self.concurrency)
+            )
+
+            start_time = time.time()
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                results = list(executor.map(self.run_query, shape_queries))
+            duration = time.time() - start_time
+
+            latencies = sorted(latency for latency, hits in results if latency is not None)
+            report.append((
+                shape,
+                len(results),
+                len(results) - len(latencies),
+                sum(hits for latency, hits in results),
+                self.percentile(latencies, 50) * 1000,
+                self.percentile(latencies, 95) * 1000,
+                self.percentile(latencies, 99) * 1000,
+                len(results) / max(duration, 0.001)
+            ))
+
+        self.logger.info('Search benchmark of index "%s":' % self.index)
+        self.logger.info(
+            '%-26s %8s %7s %10s %10s %10s %10s %10s' % ('shape', 'queries', 'errors', 'hits', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)', 'queries/s')
+        )
+        for row in report:
+            self.logger.info('%-26s %8d %7d %10d %10.1f %10.1f %10.1f %10.1f' % row)
+
+        return report
+
+    def run_query(self, query: str) -> tuple[typing.Union[float, None], int]:
+        """ Sends one query like Samba does and returns its latency in seconds (or None on errors) and its hits """
+
+        start_time = time.time()
+        try:
+            resp = self.indexer.elasticsearch.search(
+                index=self.index,
+                query={"query_string": {"query": query}},
+                source_includes=['path.real'],
+                from_=0,
+                size=100
+            )
+        except Exception as err:
+            self.logger.debug('Query "%s" failed: %s' % (query, str(err)))
+            return None, 0
+
+        return time.time() - start_time, resp['hits']['total']['value']
+
+    @staticmethod
+    def percentile(sorted_values: list[float], percent: float) -> float:
+        """ Returns the percentile of the sorted values (nearest rank) """
+        if len(sorted_values) == 0:
+            return 0
+
+        rank = max(0, min(len(sorted_values) - 1, math.ceil(percent / 100 * len(sorted_values)) - 1))
+        return sorted_values[rank]
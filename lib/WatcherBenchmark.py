@@ -0,0 +1,445 @@
+#-*- coding: utf-8 -*-
+
+import copy
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import typing
+
+from lib.FakeElasticsearch import *
+from lib.Fs2EsIndexer import *
+from lib.SearchBenchmark import *
+
+
+class WatcherBenchmark(object):
+    """
+    Replays filesystem event traces through the watch() loop of a changes watcher into a fake elasticsearch
+
+    The synthetic traces are executed in a scratch directory (and written to a scratch samba audit log for the audit
+    log watcher) at the given rate. A recorded samba audit log is replayed line by line (audit log watcher only).
+    The report contains the sustained events per second, the latency until an event is visible in elasticsearch and
+    how fast the backlog of not yet visible events grows.
+    """
+
+    TRACES = ('bulk_copy', 'recursive_delete', 'directory_rename', 'log_rotation')
+
+    # The synthetic trees consist of directories with this many files
+    FILES_PER_DIRECTORY = 100
+
+    # The files moved with each directory of the "directory_rename" trace
+    FILES_PER_RENAMED_DIRECTORY = 10
+
+    # The audit log is rotated every this many events of the "log_rotation" trace
+    AUDIT_LOG_ROTATION_EVENTS = 1000
+
+    def __init__(self, config: dict[str, typing.Any], watcher: str, events: int, rate: float, drain_timeout: float, logger):
+        self.config = config
+        self.watcher = watcher
+        self.events = events
+        self.rate = rate
+        self.drain_timeout = drain_timeout
+        self.logger = logger
+
+        # The emit times of the events that aren't visible in elasticsearch yet, by (operation, document ID)
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self.emitted = 0
+        self.visible = 0
+        self.latencies = []
+        self.last_visible_at = None
+
+        # How long the emitting took and how many events weren't visible yet at its end
+        self.emit_duration = 0
+        self.backlog_at_emit_end = 0
+
+    def run(self, traces: list[str]) -> list[tuple[str, int, int, float, float, float, float, int, float]]:
+        """
+        Runs the traces one after another and logs the report
+
+        Returns the report: trace, events, lost events, events per second, p50, p95 and p99 visibility latency
+        (in ms), the maximum backlog and the growth of the backlog (events per second) while the trace was emitted
+        """
+
+        report = []
+        for trace in traces:
+            row = self.run_trace(trace)
+            if row is not None:
+                report.append(row)
+
+        self.logger.info('Watcher benchmark of the "%s" watcher with %s:' % (
+            self.watcher,
+            'a rate of %.0f events/s' % self.rate if self.rate > 0 else 'the maximum rate'
+        ))
+        self.logger.info(
+            '%-18s %8s %6s %10s %10s %10s %10s %9s %12s' % (
+                'trace', 'events', 'lost', 'events/s', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)', 'backlog', 'backlog/s'
+            )
+        )
+        for row in report:
+            self.logger.info('%-18s %8d %6d %10.1f %10.1f %10.1f %10.1f %9d %12.1f' % row)
+
+        return report
+
+    def run_trace(self, trace: str) -> typing.Union[tuple[str, int, int, float, float, float, float, int, float], None]:
+        """ Replays one trace (a name of TRACES or the path to a recorded samba audit log) """
+
+        recorded = trace not in self.TRACES
+        if recorded and self.watcher != 'audit_log':
+            self.logger.error('A recorded samba audit log can only be replayed through the "audit_log" watcher.')
+            return None
+
+        scratch_directory = tempfile.mkdtemp(prefix='fs2es-indexer-watcher-benchmark-')
+        share_directory = os.path.join(scratch_directory, 'share')
+        audit_log = os.path.join(scratch_directory, 'audit.log')
+        os.mkdir(share_directory)
+        open(audit_log, 'w').close()
+
+        self.pending = {}
+        self.emitted = 0
+        self.visible = 0
+        self.latencies = []
+        self.last_visible_at = None
+
+        fake_elasticsearch = FakeElasticsearch(self.operation_seen)
+        try:
+            indexer = self.create_indexer(trace, share_directory, audit_log, fake_elasticsearch.start(), recorded)
+
+            if recorded:
+                self.logger.info('Replaying the recorded samba audit log "%s" ...' % trace)
+                events = self.recorded_events(trace)
+            else:
+                self.logger.info('Preparing the "%s" trace with %d events in "%s" ...' % (trace, self.events, share_directory))
+                events = self.synthetic_events(trace, share_directory, indexer, fake_elasticsearch)
+
+            if not indexer.changes_watcher.start():
+                self.logger.error('The "%s" watcher could not be started.' % self.watcher)
+                return None
+
+            return self.replay(trace, events, indexer, audit_log)
+        finally:
+            fake_elasticsearch.stop()
+            shutil.rmtree(scratch_directory, ignore_errors=True)
+
+    def create_indexer(self, trace: str, share_directory: str, audit_log: str, elasticsearch_url: str,
+                       recorded: bool) -> Fs2EsIndexer:
+        """ Creates an indexer with the configured options, but the scratch directory, audit log and fake elasticsearch """
+
+        config = copy.deepcopy(self.config)
+        for key in ('shares', 'scheduler', 'dirty_subtrees', 'crawl_governor', 'control_socket'):
+            config.pop(key, None)
+
+        if not recorded:
+            config['directories'] = [share_directory]
+
+        config['use_fanotify'] = self.watcher == 'fanotify'
+        config['samba'] = dict(config.get('samba', None) or {})
+        config['samba']['audit_log'] = audit_log
+
+        elasticsearch_config = dict(config.get('elasticsearch', None) or {})
+        elasticsearch_config['url'] = elasticsearch_url
+        elasticsearch_config['index'] = 'fs2es-indexer-watcher-benchmark'
+        elasticsearch_config.pop('user', None)
+        elasticsearch_config.pop('password', None)
+        if recorded:
+            # The recorded paths don't exist here
+            elasticsearch_config['index_file_dates'] = False
+        config['elasticsearch'] = elasticsearch_config
+
+        if 'spool' in config:
+            config['spool'] = dict(config['spool'] or {})
+            config['spool']['path'] = os.path.join(os.path.dirname(audit_log), 'spool.jsonl')
+
+        logger = self.logger.getChild(re.sub(r'\W+', '_', os.path.basename(trace)))
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            # The watchers log every call of watch()
+            logger.setLevel(logging.WARNING)
+
+        return Fs2EsIndexer(config, logger)
+
+    def synthetic_events(self, trace: str, share_directory: str, indexer: Fs2EsIndexer,
+                         fake_elasticsearch: FakeElasticsearch) -> list[tuple]:
+        """ Prepares the files of the trace (already indexed in the fake elasticsearch) and returns its events """
+
+        events = []
+        if trace == 'bulk_copy':
+            # cp -r of a tree into the share
+            copy_directory = os.path.join(share_directory, 'copy')
+            events.append(('mkdir', copy_directory))
+            events += self.tree_events(copy_directory, self.events - 1, self.FILES_PER_DIRECTORY)
+
+        elif trace == 'recursive_delete':
+            # rm -r of a tree: the files first, then their directory
+            delete_directory = os.path.join(share_directory, 'delete')
+            paths = self.prepare_tree(delete_directory, self.events - 1, self.FILES_PER_DIRECTORY)
+            self.seed(indexer, fake_elasticsearch, [delete_directory] + paths)
+            for path in reversed(paths):
+                events.append(('delete', path))
+            events.append(('delete', delete_directory))
+
+        elif trace == 'directory_rename':
+            # mv of directories, each with its files
+            rename_directory = os.path.join(share_directory, 'rename')
+            paths = self.prepare_tree(
+                rename_directory,
+                self.events * (self.FILES_PER_RENAMED_DIRECTORY + 1),
+                self.FILES_PER_RENAMED_DIRECTORY
+            )
+            self.seed(indexer, fake_elasticsearch, [rename_directory] + paths)
+            for path in paths:
+                if os.path.dirname(path) == rename_directory:
+                    events.append(('rename', path, path + '-renamed'))
+
+        elif trace == 'log_rotation':
+            # An application log in the share rotated by logrotate: app.log.3 -> app.log.4, ..., app.log -> app.log.1
+            log_directory = os.path.join(share_directory, 'logs')
+            os.mkdir(log_directory)
+            log_file = os.path.join(log_directory, 'app.log')
+            paths = [log_directory]
+            for i in range(5):
+                path = log_file if i == 0 else '%s.%d' % (log_file, i)
+                open(path, 'w').close()
+                paths.append(path)
+            self.seed(indexer, fake_elasticsearch, paths)
+
+            audit_log_rotations = 0
+            while len(events) - audit_log_rotations < self.events:
+                if self.watcher == 'audit_log' and (len(events) - audit_log_rotations) // self.AUDIT_LOG_ROTATION_EVENTS > audit_log_rotations:
+                    # The samba audit log is rotated too: alternately by renaming it and by copytruncate
+                    audit_log_rotations += 1
+                    events.append(('rotate_audit_log', audit_log_rotations, audit_log_rotations % 2 == 0))
+
+                for i in range(3, 0, -1):
+                    events.append(('rename', '%s.%d' % (log_file, i), '%s.%d' % (log_file, i + 1)))
+                events.append(('rename', log_file, log_file + '.1'))
+                events.append(('create', log_file))
+
+        return events
+
+    @staticmethod
+    def tree_events(root: str, paths: int, files_per_directory: int) -> list[tuple[str, str]]:
+        """ Returns the events creating a tree of directories with files_per_directory files each below root """
+        events = []
+        directory = None
+        while len(events) < paths:
+            if len(events) % (files_per_directory + 1) == 0:
+                directory = os.path.join(root, 'directory-%d' % len(events))
+                events.append(('mkdir', directory))
+            else:
+                events.append(('create', os.path.join(directory, 'file-%d.txt' % len(events))))
+
+        return events
+
+    def prepare_tree(self, root: str, paths: int, files_per_directory: int) -> list[str]:
+        """ Creates the tree of tree_events() below root and returns its paths in the order of creation """
+        os.mkdir(root)
+        events = self.tree_events(root, paths, files_per_directory)
+        for event in events:
+            self.execute(event)
+
+        return [event[1] for event in events]
+
+    @staticmethod
+    def seed(indexer: Fs2EsIndexer, fake_elasticsearch: FakeElasticsearch, paths: list[str]):
+        """ Indexes the prepared paths into the fake elasticsearch (without reporting them) """
+        for path in paths:
+            document = indexer.elasticsearch_map_path_to_document(path=path, filename=os.path.basename(path))
+            if document is not None:
+                fake_elasticsearch.index_document(document['_id'], document['_source'], report=False)
+
+    @staticmethod
+    def recorded_events(audit_log: str) -> list[tuple]:
+        """ Reads the lines of a recorded samba audit log """
+        with open(audit_log, 'r', errors='replace') as f:
+            return [('audit_line', line if line.endswith('\n') else line + '\n') for line in f]
+
+    def replay(self, trace: str, events: list[tuple], indexer: Fs2EsIndexer, audit_log: str):
+        """ Emits the events in a thread and runs the watch() loop until all are visible (or the drain timeout) """
+
+        start_time = time.time()
+        emitter = threading.Thread(
+            target=self.emit,
+            args=(events, indexer, audit_log, start_time),
+            name='fs2es-indexer-watcher-benchmark',
+            daemon=True
+        )
+
+        # The backlog (emitted, but not yet visible events) over time
+        backlog_samples = []
+        sampling = threading.Event()
+
+        def sample_backlog():
+            while not sampling.wait(0.1):
+                backlog_samples.append((time.time() - start_time, self.emitted - self.visible))
+
+        sampler = threading.Thread(target=sample_backlog, name='fs2es-indexer-watcher-benchmark-backlog', daemon=True)
+
+        emitter.start()
+        sampler.start()
+
+        drain_until = None
+        while True:
+            indexer.changes_watcher.watch(1)
+
+            if emitter.is_alive():
+                continue
+
+            if drain_until is None:
+                drain_until = time.time() + self.drain_timeout
+
+            with self.pending_lock:
+                pending = sum(len(emit_times) for emit_times in self.pending.values())
+
+            if pending == 0 or time.time() > drain_until:
+                break
+
+        sampling.set()
+        sampler.join()
+
+        latencies = sorted(self.latencies)
+        duration = (self.last_visible_at or time.time()) - start_time
+
+        if pending > 0:
+            self.logger.info('%d event(s) of the "%s" trace weren\'t visible after the drain timeout.' % (pending, trace))
+
+        return (
+            os.path.basename(trace),
+            self.emitted,
+            pending,
+            self.visible / max(duration, 0.001),
+            SearchBenchmark.percentile(latencies, 50) * 1000,
+            SearchBenchmark.percentile(latencies, 95) * 1000,
+            SearchBenchmark.percentile(latencies, 99) * 1000,
+            max([backlog for at, backlog in backlog_samples] + [self.backlog_at_emit_end]),
+            # The backlog left when the last event was emitted, spread over the time the trace was emitted
+            self.backlog_at_emit_end / max(self.emit_duration, 0.001)
+        )
+
+    def emit(self, events: list[tuple], indexer: Fs2EsIndexer, audit_log: str, start_time: float):
+        """ Emits the events at the configured rate: executes them and writes them to the samba audit log """
+
+        audit_log_file = open(audit_log, 'a', buffering=1) if self.watcher == 'audit_log' else None
+        try:
+            for i, event in enumerate(events):
+                if self.rate > 0:
+                    delay = start_time + i / self.rate - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+
+                if event[0] == 'rotate_audit_log':
+                    audit_log_file = self.rotate_audit_log(audit_log_file, audit_log, event[1], event[2])
+                    continue
+
+                line = event[1] if event[0] == 'audit_line' else self.audit_line(event)
+
+                # Expect the operation before it happens, the watcher may be faster than us
+                expected = self.expected_operation(line, indexer)
+                if expected is not None:
+                    with self.pending_lock:
+                        self.pending.setdefault(expected, []).append(time.time())
+                        self.emitted += 1
+
+                if event[0] != 'audit_line':
+                    self.execute(event)
+
+                if audit_log_file is not None:
+                    audit_log_file.write(line)
+        finally:
+            if audit_log_file is not None:
+                audit_log_file.close()
+
+            self.emit_duration = time.time() - start_time
+            with self.pending_lock:
+                self.backlog_at_emit_end = self.emitted - self.visible
+
+    @staticmethod
+    def execute(event: tuple):
+        """ Executes a synthetic event in the filesystem """
+        if event[0] == 'mkdir':
+            os.mkdir(event[1])
+        elif event[0] == 'create':
+            open(event[1], 'w').close()
+        elif event[0] == 'delete':
+            if os.path.isdir(event[1]):
+                os.rmdir(event[1])
+            else:
+                os.unlink(event[1])
+        elif event[0] == 'rename':
+            os.rename(event[1], event[2])
+
+    @staticmethod
+    def audit_line(event: tuple) -> str:
+        """ Returns the line samba's full_audit would log for a synthetic event """
+        if event[0] == 'mkdir':
+            return 'benchmark|127.0.0.1|mkdirat|ok|%s\n' % event[1]
+        elif event[0] == 'create':
+            return 'benchmark|127.0.0.1|openat|ok|w|%s\n' % event[1]
+        elif event[0] == 'delete':
+            return 'benchmark|127.0.0.1|unlinkat|ok|%s\n' % event[1]
+        elif event[0] == 'rename':
+            return 'benchmark|127.0.0.1|renameat|ok|%s|%s\n' % (event[1], event[2])
+
+    @staticmethod
+    def expected_operation(line: str, indexer: Fs2EsIndexer) -> typing.Union[tuple[str, str], None]:
+        """ Returns the elasticsearch operation (and document ID) that makes the event of the audit log line visible """
+
+        # The same lines the AuditLogChangesWatcher reacts to
+        re_match = re.match(r'^.*\|(openat|unlinkat|renameat|mkdirat)\|ok\|(.*)$', line)
+        if not re_match:
+            return None
+
+        operation = re_match.group(1)
+        values = re_match.group(2).split('|')
+        if operation == 'openat':
+            if len(values) < 2 or values[0] != 'w':
+                return None
+            operation, path = 'index', values[1]
+        elif operation == 'renameat':
+            if len(values) < 2 or ':' in values[0]:
+                return None
+            operation, path = 'index', values[1]
+        elif operation == 'mkdirat':
+            operation, path = 'index', values[0]
+        else:
+            operation, path = 'delete', values[0]
+
+        if ':' in path or not indexer.path_should_be_indexed(path, True):
+            return None
+
+        return operation, indexer.elasticsearch_map_path_to_id(path)
+
+    @staticmethod
+    def rotate_audit_log(audit_log_file: typing.IO, audit_log: str, rotation: int, copytruncate: bool) -> typing.IO:
+        """
+        Rotates the samba audit log like logrotate does (with or without "copytruncate")
+
+        With "copytruncate" the lines the watcher didn't read yet are lost, the report contains them.
+        """
+        if copytruncate:
+            audit_log_file.flush()
+            shutil.copyfile(audit_log, '%s.%d' % (audit_log, rotation))
+            os.truncate(audit_log, 0)
+            return audit_log_file
+
+        audit_log_file.close()
+        os.rename(audit_log, '%s.%d' % (audit_log, rotation))
+        return open(audit_log, 'a', buffering=1)
+
+    def operation_seen(self, operation: str, document_id: str):
+        """ Called by the fake elasticsearch for every operation: the expected event of it is visible now """
+        now = time.time()
+        with self.pending_lock:
+            emit_times = self.pending.get((operation, document_id), None)
+            if emit_times is None:
+                return
+
+            # Every event causes its own operation (e. g. each rotation indexes "app.log.1" again): the oldest first
+            self.latencies.append(now - emit_times.pop(0))
+            if len(emit_times) == 0:
+                del self.pending[(operation, document_id)]
+
+            self.visible += 1
+            self.last_visible_at = now
@@ -0,0 +1,163 @@
+#-*- coding: utf-8 -*-
+
+import fcntl
+import json
+import os
+import time
+import typing
+
+
+class WriteAheadSpool(object):
+    """
+    An append-only spool file for elasticsearch operations that could not be sent (yet)
+
+    Each operation is one line of JSON:
+    - index:  ["i", "<document id>", {<document source>}]
+    - delete: ["d", "<document id>"]
+
+    The spool is replayed in order, so replaying it twice (e.g. after a crash during the replay) is harmless:
+    index and delete operations by ID are idempotent.
+    Only one process may use the spool at a time, it's locked exclusively while it's open.
+    """
+
+    def __init__(self, spool_config: dict[str, typing.Any], logger):
+        self.logger = logger
+
+        self.path = spool_config.get('path', '/var/lib/fs2es-indexer/spool.jsonl')
+        self.fsync_batch_size = spool_config.get('fsync_batch_size', 1000)
+        self.fsync_interval = spool_config.get('fsync_interval', 1)
+        self.retry_interval = spool_config.get('retry_interval', 30)
+
+        self.file = None
+        self.records_pending = 0
+        self.records_unsynced = 0
+        self.last_sync_time = time.time()
+        self.last_replay_time = 0
+
+    def open(self) -> bool:
+        """
+        Opens (or creates) and locks the spool file and counts the operations still waiting in it
+
+        Returns False if another process (e. g. the daemon) holds the lock: then this process must not use the spool.
+        """
+
+        spool_directory = os.path.dirname(self.path)
+        if spool_directory != '':
+            os.makedirs(spool_directory, exist_ok=True)
+
+        self.file = open(self.path, 'a+', encoding='utf-8')
+        try:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.file.close()
+            self.file = None
+            return False
+
+        self.file.seek(0)
+        self.records_pending = sum(1 for line in self.file if line.strip() != '')
+        self.file.seek(0, 2)
+
+        if self.records_pending > 0:
+            self.logger.info(
+                'Spool "%s" contains %d operation(s) which werent sent to elasticsearch yet.' % (
+                    self.path,
+                    self.records_pending
+                )
+            )
+
+        return True
+
+    def has_pending(self) -> bool:
+        """ Are there any operations in the spool which must be replayed first? """
+        return self.records_pending > 0
+
+    def replay_due(self) -> bool:
+        """ Is it time to try to replay the spool again? """
+        return time.time() - self.last_replay_time >= self.retry_interval
+
+    def append(self, documents: list[dict]):
+        """ Appends the given bulk documents (with "_op_type" index or delete) to the spool """
+
+        for document in documents:
+            if document.get('_op_type', 'index') == 'delete':
+                record = ['d', document['_id']]
+            else:
+                record = ['i', document['_id'], document['_source']]
+
+            self.file.write(json.dumps(record, separators=(',', ':')))
+            self.file.write('\n')
+
+        self.records_pending += len(documents)
+        self.records_unsynced += len(documents)
+
+        if self.records_unsynced >= self.fsync_batch_size or time.time() - self.last_sync_time >= self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        """ Flushes all written operations to the disk """
+
+        if self.records_unsynced == 0:
+            return
+
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.records_unsynced = 0
+        self.last_sync_time = time.time()
+
+    def replay(self, bulk_size: int, bulk_action: typing.Callable[[list[dict]], None]) -> int:
+        """
+        Sends all spooled operations in order in chunks of bulk_size via bulk_action.
+
+        If bulk_action raises an exception, the replay stops and the spool is kept (and replayed from the start
+        during the next attempt). If all operations were sent, the spool is truncated.
+        """
+
+        self.last_replay_time = time.time()
+        self.sync()
+
+        self.logger.info('Replaying %d spooled operation(s) from "%s" ...' % (self.records_pending, self.path))
+
+        replayed = 0
+        documents = []
+        self.file.seek(0)
+        for line in self.file:
+            if line.strip() == '':
+                continue
+
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Probably a partially written last line after a crash: it was never fsynced, so ignore it
+                self.logger.error('Ignoring corrupt line in spool "%s": %s' % (self.path, line.strip()))
+                continue
+
+            if record[0] == 'd':
+                documents.append({'_op_type': 'delete', '_id': record[1]})
+            else:
+                documents.append({'_op_type': 'index', '_id': record[1], '_source': record[2]})
+
+            if len(documents) >= bulk_size:
+                bulk_action(documents)
+                replayed += len(documents)
+                documents = []
+
+        if len(documents) > 0:
+            bulk_action(documents)
+            replayed += len(documents)
+
+        self.file.seek(0)
+        self.file.truncate()
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.records_pending = 0
+
+        self.logger.info('Replayed %d spooled operation(s), spool "%s" is empty now.' % (replayed, self.path))
+
+        return replayed
+
+    def close(self):
+        """ Syncs and closes the spool file """
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.file = None